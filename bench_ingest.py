@@ -0,0 +1,300 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Ingest benchmark. Simulates planets reporting to report.py and measures how fast reports are absorbed.
+#
+# Bench planets and targets are created in the database of credential.py before the run, and removed
+# after it, so runs start from the same state. Each round is one ping frequency: all planets send
+# their reports of every target at once, like Planets do at the start of a minute. Rounds follow each
+# other without waiting unless --interval is given. Report values come from a seeded generator, so
+# runs with the same arguments send the same reports.
+#
+# By default report.py is served from a child process whose database pool is instrumented to
+# measure time spent waiting for a connection. With --url, a running server is benchmarked
+# instead, and pool wait is not measured.
+#
+#   python bench_ingest.py --planets 20 --targets 50 --rounds 10 --output result.json
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import multiprocessing
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.web
+import config
+import database
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def summary(values):
+    """Percentiles of seconds, in milliseconds."""
+    return {
+        "count": len(values),
+        "p50": None if not values else percentile(values, 0.5) * 1000,
+        "p99": None if not values else percentile(values, 0.99) * 1000,
+        "max": None if not values else max(values) * 1000,
+    }
+
+
+class Fleet:
+    """Bench planets and targets, and the reports they send."""
+
+    def __init__(self, planets, targets, seed, prefix='bench', network='198.18.0.0/16'):
+        self.planets = [(f'{prefix}_planet_{i}', f'{prefix}_secret_{i}') for i in range(planets)]
+        # Benchmarking address range (RFC 2544) by default, never a real target.
+        network = ipaddress.ip_network(network)
+        self.targets = [(f'{prefix}_target_{i}', str(network[i + 1])) for i in range(targets)]
+        self.random = random.Random(seed)
+
+    async def setup(self, db: database.Database):
+        nodes = [name for name, _ in self.planets]
+        for name, secret in self.planets:
+            await db.add_new_node(name, secret, 'planet')
+        for name, ip in self.targets:
+            await db.add_target(name, ip, nodes=nodes)
+
+    async def cleanup(self, db: database.Database):
+        for name, _ in self.planets:
+            if name in db.nodes:
+                await db.remove_exist_node(name)
+        async with db.pool.acquire() as conn:
+            names = [name for name, _ in self.targets]
+            await conn.execute("DELETE FROM StarPing_PingTargets WHERE name = any($1::text[]);", names)
+            await conn.execute("DELETE FROM StarPing_MTRTargets WHERE name = any($1::text[]);", names)
+
+    def ping(self, stamp, ip):
+        if self.random.random() < 0.02:
+            stat = {"timeout": True, "avg": 0, "min": 0, "max": 0, "std_dev": 0,
+                    "drop": config.ping_config["count"], "total": config.ping_config["count"]}
+        else:
+            low = self.random.uniform(1, 300)
+            high = low + self.random.expovariate(0.2)
+            stat = {"timeout": False, "avg": (low + high) / 2, "min": low, "max": high,
+                    "std_dev": (high - low) / 4, "drop": int(self.random.random() < 0.05),
+                    "total": config.ping_config["count"]}
+        return {"time": int(stamp * 1000000000), "report": {"ip": ip, "stat": stat}}
+
+    def mtr(self, stamp, ip):
+        hops = []
+        hop_count = self.random.randint(4, 20)
+        for index in range(1, hop_count + 1):
+            addr = str(ipaddress.ip_address('10.0.0.0') + self.random.randrange(1 << 24))
+            low = index * self.random.uniform(0.5, 10)
+            hops.append({"index": index, "timeout": False,
+                         "addr": [{"ip": addr, "rdns": "", "code": 256}],
+                         "avg": low + 1, "min": low, "max": low + 2, "std_dev": 0.5,
+                         "drop": 0, "total": config.mtr_config["count"]})
+        return {"time": int(stamp * 1000000000), "report": {"ip": ip, "hop_count": hop_count, "stat": hops}}
+
+    def round(self, stamp, mtr, batch):
+        """Requests of every planet for one round, as (name, type, body, reports)."""
+        requests = []
+        for name, _ in self.planets:
+            pings = [self.ping(stamp, ip) for _, ip in self.targets]
+            mtrs = [self.mtr(stamp, ip) for _, ip in self.targets] if mtr else []
+            if batch:
+                requests.append((name, 'batch', {"ping": pings, "mtr": mtrs}, len(pings) + len(mtrs)))
+            else:
+                requests.extend((name, 'ping', p, 1) for p in pings)
+                requests.extend((name, 'mtr', p, 1) for p in mtrs)
+        return requests
+
+
+def sign(secret, body):
+    return hmac.HMAC(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+class PoolStatsHandler(tornado.web.RequestHandler):
+    def initialize(self, waits):
+        self.waits = waits
+
+    async def get(self):
+        self.write(json.dumps(self.waits))
+        self.waits.clear()
+
+
+class TimedAcquire:
+    """Pool acquire context recording how long it waited for a connection."""
+
+    def __init__(self, acquire, waits):
+        self.acquire = acquire
+        self.waits = waits
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        try:
+            return await self.acquire.__aenter__()
+        finally:
+            self.waits.append(time.perf_counter() - start)
+
+    async def __aexit__(self, *exc):
+        return await self.acquire.__aexit__(*exc)
+
+
+def serve(port):
+    """Serve report.py in this process, with pool waits kept for /bench/pool."""
+    import report
+    if platform.system() == "Windows":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    db = event_loop.run_until_complete(database.get_db(database.pool_size(1)))
+    waits = []
+    acquire = db.pool.acquire
+    db.pool.acquire = lambda *args, **kwargs: TimedAcquire(acquire(*args, **kwargs), waits)
+    report.application.settings['db'] = db
+    report.application.settings['ingest'] = report.IngestBuffer(db, **config.ingest_config)
+    report.application.settings['ingest'].start()
+    report.application.add_handlers(r'.*', [(r'/bench/pool', PoolStatsHandler, {"waits": waits})])
+    server = tornado.httpserver.HTTPServer(report.application, xheaders=True)
+    server.listen(port, '127.0.0.1')
+    tornado.ioloop.IOLoop.current().start()
+
+
+async def wait_ready(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client.fetch(url + '/nodes/api/config', raise_error=False)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def send(client, url, secrets, request, latencies, errors):
+    name, typ, p, _ = request
+    body = json.dumps(p).encode()
+    start = time.perf_counter()
+    response = await client.fetch(f'{url}/nodes/api/report?type={typ}', method='POST', body=body,
+                                  headers={'X-StarPing-Name': name, 'X-StarPing-Signature': sign(secrets[name], body)},
+                                  connect_timeout=600, request_timeout=600, raise_error=False)
+    latencies.append(time.perf_counter() - start)
+    if response.code != 200:
+        key = f'{response.code} {response.body.decode(errors="replace") if response.body else response.reason}'
+        errors[key] = errors.get(key, 0) + 1
+    elif typ == 'batch':
+        for i in json.loads(response.body)['rejected']:
+            errors[i['message']] = errors.get(i['message'], 0) + 1
+
+
+async def run(args):
+    fleet = Fleet(args.planets, args.targets, args.seed)
+    secrets = dict(fleet.planets)
+    db = await database.get_db(2)
+    await fleet.cleanup(db)
+    await fleet.setup(db)
+    server = None
+    url = args.url
+    if url is None:
+        # Spawned, not forked, so it shares no connection with this process.
+        server = multiprocessing.get_context('spawn').Process(target=serve, args=(args.port,), daemon=True)
+        server.start()
+        url = f'http://127.0.0.1:{args.port}'
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=args.concurrency)
+    try:
+        await wait_ready(client, url)
+        if server is not None:
+            # Forget connection waits of start up.
+            await client.fetch(url + '/bench/pool')
+        frequency = config.ping_config["frequency"]
+        base = time.time() // frequency * frequency
+        mtr_every = max(config.mtr_config["frequency"] // frequency, 1)
+        latencies, errors, rounds, reports = [], dict(), [], 0
+        start = time.perf_counter()
+        for i in range(args.rounds):
+            requests = fleet.round(base + i * frequency, args.mtr and i % mtr_every == 0, args.batch)
+            round_start = time.perf_counter()
+            await asyncio.gather(*(send(client, url, secrets, r, latencies, errors) for r in requests))
+            rounds.append(time.perf_counter() - round_start)
+            reports += sum(r[3] for r in requests)
+            if args.interval and i != args.rounds - 1:
+                await asyncio.sleep(max(args.interval - rounds[-1], 0))
+        elapsed = time.perf_counter() - start
+        pool_wait = json.loads((await client.fetch(url + '/bench/pool')).body) if server is not None else None
+    finally:
+        client.close()
+        if server is not None:
+            server.terminate()
+            server.join()
+        await fleet.cleanup(db)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "arguments": {i: getattr(args, i) for i in ('planets', 'targets', 'rounds', 'interval', 'mtr', 'batch',
+                                                     'concurrency', 'seed')},
+        "ingest_config": config.ingest_config,
+        "reports": reports,
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "reports_per_second": reports / elapsed,
+        "round_seconds": summary(rounds),
+        "latency_ms": summary(latencies),
+        "pool_wait_ms": None if pool_wait is None else summary(pool_wait),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark report ingestion with simulated planets.")
+    parser.add_argument('--planets', type=int, default=10)
+    parser.add_argument('--targets', type=int, default=20, help="targets reported by each planet")
+    parser.add_argument('--rounds', type=int, default=5, help="ping frequencies to simulate")
+    parser.add_argument('--interval', type=float, default=0, help="s between round starts, 0 to run back to back")
+    parser.add_argument('--mtr', action='store_true', help="also send mtr reports, once every mtr frequency")
+    parser.add_argument('--batch', action='store_true', help="send each planet's round as one batch report")
+    parser.add_argument('--concurrency', type=int, default=1000,
+                        help="requests in flight at most. Latency includes waiting for one of them")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help="benchmark a running server instead of starting one")
+    parser.add_argument('--port', type=int, default=14080, help="port of the server started")
+    parser.add_argument('--output', help="also write result JSON to this file")
+    args = parser.parse_args()
+
+    if platform.system() == "Windows":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    result = asyncio.get_event_loop().run_until_complete(run(args))
+    json.dump(result, sys.stdout, indent=2)
+    print()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
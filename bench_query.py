@@ -0,0 +1,356 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Query benchmark. Loads synthetic history, then measures the public queries over it.
+#
+#   python bench_query.py load --planets 50 --targets 500 --days 90
+#   python bench_query.py run --planets 50 --targets 500 --output result.json
+#   python bench_query.py clean --planets 50 --targets 500
+#
+# `load` creates history planets and targets in the database of credential.py, and fills them
+# with a record every ping frequency (and a mtr record every mtr frequency) over the last days
+# with COPY, then builds rollups. Records are generated from the seed, so loads with the same
+# arguments hold the same records. Row triggers are skipped when the database user may set
+# session_replication_role, so loading doesn't announce every record.
+#
+# `run` calls every public query method of Database at each span, and the HTTP endpoints serving
+# them from a main.py spawned with rate limits and response cache off. Latency percentiles and
+# EXPLAIN ANALYZE plans of the statements run are written as JSON. Planets and targets given to
+# `run` must match the ones loaded.
+
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import asyncpg
+import tornado.httpclient
+import tornado.httpserver
+import tornado.httputil
+import tornado.ioloop
+import config
+import database
+from bench_ingest import Fleet, summary, wait_ready
+
+
+def history(args):
+    return Fleet(args.planets, args.targets, args.seed, prefix='history', network='198.19.0.0/16')
+
+
+def ping_rows(node, targets, start, end, seed):
+    """Ping records of a node for [start, end), generated the same for the same seed."""
+    frequency = config.ping_config["frequency"]
+    count = config.ping_config["count"]
+    for name, _ in targets:
+        rng = random.Random(f'{seed}-{node}-{name}-{start}')
+        base = rng.uniform(1, 300)
+        stamp = start
+        while stamp < end:
+            time_ = datetime.datetime.fromtimestamp(stamp, datetime.timezone.utc)
+            if rng.random() < 0.01:
+                yield node, time_, name, True, 0, 0, 0, 0, count, count
+            else:
+                low = base + rng.expovariate(1)
+                high = low + rng.expovariate(0.2)
+                yield node, time_, name, False, (low + high) / 2, low, high, (high - low) / 4, \
+                    int(rng.random() < 0.05), count
+            stamp += frequency
+
+
+def mtr_rows(node, targets, start, end, seed):
+    """Mtr records of a node for [start, end), generated the same for the same seed."""
+    frequency = config.mtr_config["frequency"]
+    for name, _ in targets:
+        rng = random.Random(f'{seed}-{node}-{name}-{start}-mtr')
+        route = [f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}'
+                 for _ in range(rng.randint(4, 20))]
+        stamp = start
+        while stamp < end:
+            hops = [{"index": index + 1, "timeout": False, "addr": [{"ip": ip, "rdns": "", "code": 256}],
+                     "avg": (index + 1) * 2.0, "min": index + 1.0, "max": (index + 1) * 3.0, "std_dev": 0.5,
+                     "drop": 0, "total": config.mtr_config["count"]} for index, ip in enumerate(route)]
+            yield (node, datetime.datetime.fromtimestamp(stamp, datetime.timezone.utc), name, len(hops),
+                   database.route_fingerprint(hops)) + database.hop_columns(hops)
+            stamp += frequency
+
+
+async def load_node(db: database.Database, node, targets, start, end, args):
+    """Copy history of a node a day at a time, returning rows copied."""
+    copied = 0
+    async with db.pool.acquire() as conn:
+        try:
+            await conn.execute("SET session_replication_role = replica;")
+        except asyncpg.InsufficientPrivilegeError:
+            pass
+        day = start
+        while day < end:
+            until = min(day + 24 * 60 * 60, end)
+            rows = list(ping_rows(node, targets, day, until, args.seed))
+            await conn.copy_records_to_table('starping_pingdata', records=rows, columns=(
+                'node', 'time', 'name', 'timeout', 'avg', 'min', 'max', 'std_dev', 'drop', 'total'))
+            copied += len(rows)
+            if args.mtr:
+                rows = list(mtr_rows(node, targets, day, until, args.seed))
+                await conn.copy_records_to_table('starping_mtrdata', records=rows, columns=database.mtr_columns)
+                copied += len(rows)
+            day = until
+        await conn.execute("RESET session_replication_role;")
+    return copied
+
+
+async def load(args):
+    fleet = history(args)
+    db = await database.get_db(args.jobs)
+    await fleet.cleanup(db)
+    await fleet.setup(db)
+    now = time.time()
+    # Align to mtr frequency, a multiple of ping frequency, so both kinds start together.
+    start = (now - args.days * 24 * 60 * 60) // config.mtr_config["frequency"] * config.mtr_config["frequency"]
+    end = now // config.ping_config["frequency"] * config.ping_config["frequency"]
+    first = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+    last = datetime.datetime.fromtimestamp(end, datetime.timezone.utc)
+    span = (last.year - first.year) * 12 + last.month - first.month + 1
+    async with db.pool.acquire() as conn:
+        for node, _ in fleet.planets:
+            for table in ('StarPing_PingData', 'StarPing_MTRData'):
+                for year, month in database.months(first.year, first.month, span):
+                    await database.create_month_partition(conn, f'{table}_{node}', year, month)
+
+    began = time.perf_counter()
+    jobs = asyncio.Semaphore(args.jobs)
+
+    async def job(node):
+        async with jobs:
+            return await load_node(db, node, fleet.targets, start, end, args)
+
+    rows = sum(await asyncio.gather(*(job(node) for node, _ in fleet.planets)))
+    copied = time.perf_counter() - began
+    async with db.pool.acquire() as conn:
+        await conn.execute("ANALYZE StarPing_PingData;")
+        await conn.execute("ANALYZE StarPing_MTRData;")
+    if args.rollup:
+        await db.update_rollup()
+        async with db.pool.acquire() as conn:
+            await conn.execute("ANALYZE StarPing_PingRollup;")
+    return {
+        "arguments": {i: getattr(args, i) for i in ('planets', 'targets', 'days', 'mtr', 'rollup', 'seed')},
+        "rows": rows,
+        "copy_seconds": copied,
+        "rows_per_second": rows / copied if copied else None,
+        "seconds": time.perf_counter() - began,
+    }
+
+
+def explained(plan):
+    """Relations scanned sequentially in a plan, a hint of a missing index."""
+    scans = []
+    if plan.get('Node Type') == 'Seq Scan':
+        scans.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', ()):
+        scans.extend(explained(child))
+    return scans
+
+
+async def explain(db: database.Database, name, *args):
+    async with db.pool.acquire() as conn:
+        plan = json.loads(await conn.fetchval(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {database.statements[name]}",
+                                              *args))
+    return {"statement": name, "seq_scans": explained(plan[0]['Plan']), "plan": plan}
+
+
+def method_cases(db, spans, now):
+    """(case name, query coroutine function, statement the query runs with its arguments) of each case."""
+    cases = []
+    for hours in spans:
+        start = now - hours * 60 * 60
+        resolution = database.ping_resolution(start, now)
+        raw = resolution == config.ping_config["frequency"]
+        cases.append((f'query_ping_hours {hours}h',
+                      lambda node, target, hours=hours: db.query_ping_hours(node, target, hours),
+                      lambda node, target, start=start, resolution=resolution, raw=raw: (
+                          'ping_timespan' if raw else 'ping_rollup_timespan', node, target, start, now, resolution)))
+        cases.append((f'query_pingavg_hours {hours}h',
+                      lambda node, target, hours=hours: db.query_pingavg_hours(target, hours),
+                      lambda node, target, start=start, resolution=resolution, raw=raw: (
+                          ('pingavg_timespan', target, start, now) if raw else
+                          ('pingavg_rollup_timespan', target, start, now, resolution))))
+        cases.append((f'query_mtr_from {hours}h',
+                      lambda node, target, start=start: db.query_mtr_from(node, target, start),
+                      lambda node, target, start=start: ('mtr_from', node, target, start)))
+        cases.append((f'query_mtr_changes {hours}h',
+                      lambda node, target, start=start: db.query_mtr_changes(node, target, start, now),
+                      lambda node, target, start=start: ('mtr_changes', node, target, start, now)))
+    return cases
+
+
+def http_cases(spans, now):
+    """(case name, path, arguments from (node, target)) of each endpoint case, within limits of the endpoints."""
+    cases = [
+        ('/api/record', '/api/record', lambda node, target: {"target": target}),
+        ('/api/detailRecord', '/api/detailRecord', lambda node, target: {"node": node, "target": target}),
+    ]
+    for hours in spans:
+        if hours <= 168:
+            cases.append((f'/api/record/longterm {hours}h', '/api/record/longterm',
+                          lambda node, target, hours=hours: {"target": target, "span": hours}))
+        if hours % 24 == 0 and hours <= 30 * 24:
+            cases.append((f'/api/detailRecord/longterm {hours}h', '/api/detailRecord/longterm',
+                          lambda node, target, hours=hours: {"node": node, "target": target, "span": hours // 24}))
+        cases.append((f'/api/route {hours}h', '/api/route',
+                      lambda node, target, hours=hours: {"node": node, "target": target,
+                                                         "time": now - hours * 60 * 60}))
+    return cases
+
+
+def serve(port):
+    """Serve main.py APIs in this process, with rate limits and response cache off."""
+    import logging
+    for endpoint in config.rate_limits:
+        config.rate_limits[endpoint] = {"duration": 1, "burst": 1 << 30}
+    config.rate_limit_backend = 'memory'
+    config.cache_config["size"] = 0
+    config.server_config["debug"] = False
+    import main
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    if platform.system() == "Windows":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    main.application.settings['db'] = event_loop.run_until_complete(database.get_db(database.pool_size(1)))
+    main.application.settings['cache'] = main.ResponseCache(**config.cache_config)
+    # Queries go to database, which is what is measured.
+    main.application.settings['recent'] = main.application.settings['db']
+    server = tornado.httpserver.HTTPServer(main.application)
+    server.listen(port, '127.0.0.1')
+    tornado.ioloop.IOLoop.current().start()
+
+
+async def run(args):
+    fleet = history(args)
+    rng = random.Random(args.seed)
+    db = await database.get_db(2)
+    missing = [name for name, _ in fleet.planets if name not in db.nodes]
+    if missing:
+        raise RuntimeError(f'History planets missing: {", ".join(missing)}. Run load with the same arguments first.')
+    now = time.time()
+
+    def pairs():
+        return [(rng.choice(fleet.planets)[0], rng.choice(fleet.targets)[0]) for _ in range(args.repeat)]
+
+    methods, plans = dict(), dict()
+    for name, query, statement in method_cases(db, args.spans, now):
+        latencies = []
+        for node, target in pairs():
+            start = time.perf_counter()
+            _, err = await query(node, target)
+            latencies.append(time.perf_counter() - start)
+            if err is not None:
+                raise RuntimeError(f'{name} refused {node}, {target}: {err}')
+        methods[name] = summary(latencies)
+        node, target = pairs()[0]
+        plans[name] = await explain(db, *statement(node, target))
+
+    http = dict()
+    if args.http:
+        server = multiprocessing.get_context('spawn').Process(target=serve, args=(args.port,), daemon=True)
+        server.start()
+        url = f'http://127.0.0.1:{args.port}'
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            await wait_ready(client, url)
+            for name, path, arguments in http_cases(args.spans, now):
+                latencies, errors = [], dict()
+                for node, target in pairs():
+                    start = time.perf_counter()
+                    response = await client.fetch(url + tornado.httputil.url_concat(path, arguments(node, target)),
+                                                  headers={"Accept-Encoding": "identity"}, request_timeout=600,
+                                                  raise_error=False)
+                    latencies.append(time.perf_counter() - start)
+                    if response.code != 200:
+                        errors[response.code] = errors.get(response.code, 0) + 1
+                http[name] = dict(summary(latencies), errors=errors)
+        finally:
+            client.close()
+            server.terminate()
+            server.join()
+
+    async with db.pool.acquire() as conn:
+        scale = {i['relname']: i['rows'] for i in await conn.fetch(
+                "select relname, reltuples::bigint as rows from pg_class where relname in "
+                "('starping_pingdata', 'starping_mtrdata', 'starping_pingrollup') or "
+                "(relname like 'starping_pingdata_history%' and relkind = 'r') or "
+                "(relname like 'starping_mtrdata_history%' and relkind = 'r');")}
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "arguments": {i: getattr(args, i) for i in ('planets', 'targets', 'spans', 'repeat', 'http', 'seed')},
+        "rows": {"ping": sum(j for i, j in scale.items() if i.startswith('starping_pingdata_')),
+                 "mtr": sum(j for i, j in scale.items() if i.startswith('starping_mtrdata_'))},
+        "methods_ms": methods,
+        "http_ms": http,
+        "plans": plans,
+    }
+
+
+async def clean(args):
+    db = await database.get_db(2)
+    await history(args).cleanup(db)
+    return {"cleaned": True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load synthetic history and benchmark queries over it.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command in ('load', 'run', 'clean'):
+        sub = commands.add_parser(command)
+        sub.add_argument('--planets', type=int, default=5)
+        sub.add_argument('--targets', type=int, default=50)
+        sub.add_argument('--seed', type=int, default=0)
+        sub.add_argument('--output', help="also write result JSON to this file")
+        if command == 'load':
+            sub.add_argument('--days', type=int, default=30, help="days of history")
+            sub.add_argument('--no-mtr', dest='mtr', action='store_false', help="don't load mtr records")
+            sub.add_argument('--no-rollup', dest='rollup', action='store_false', help="don't build rollups")
+            sub.add_argument('--jobs', type=int, default=4, help="nodes copied at once")
+        elif command == 'run':
+            sub.add_argument('--spans', type=lambda i: [int(j) for j in i.split(',')],
+                             default=[1, 6, 24, 168, 720, 2160], help="comma separated hours")
+            sub.add_argument('--repeat', type=int, default=20, help="runs of each case")
+            sub.add_argument('--no-http', dest='http', action='store_false', help="don't benchmark HTTP endpoints")
+            sub.add_argument('--port', type=int, default=14081, help="port of the server started")
+    args = parser.parse_args()
+
+    if platform.system() == "Windows":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    result = asyncio.get_event_loop().run_until_complete(globals()[args.command](args))
+    json.dump(result, sys.stdout, indent=2)
+    print()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
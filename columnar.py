@@ -0,0 +1,111 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compact columnar encoding of chart series, decoded by decodeColumnar in charts.js.
+#
+# A response is a uint32 header length, the header and the column buffers, all little-endian.
+# The header is the JSON response with each column replaced by {"column": type, "count": n, ...},
+# padded with spaces to a multiple of 4 bytes. Column buffers follow in the order columns
+# appear in the header, each padded with zeros to a multiple of 4 bytes:
+#   delta:   uint32 difference from the previous value, the first value is "base" of the header.
+#   bitmap:  bit i & 7 of byte i >> 3 is set for true.
+#   float32: values, NaN for null.
+# An object {"rows": {name: column, ...}} stands for a list of {name: value, ...}.
+# An object {"keys": [key, ...], "values": [value, ...]} stands for {key: value, ...}, used where keys
+# come from data (as node names) since JavaScript enumerates integer-like keys first.
+
+import array
+import json
+import math
+import struct
+import sys
+
+mime = 'application/x-starping-columnar'
+
+column_types = {
+    'time': 'delta',
+    'stamp': 'delta',
+    'timeout': 'bitmap',
+    'avg': 'float32',
+    'min': 'float32',
+    'max': 'float32',
+    'std_dev': 'float32',
+    'drop': 'float32',
+    'total': 'float32',
+    'timeouts': 'float32',
+}
+
+
+def pad(body: bytearray):
+    body.extend(bytes(-len(body) % 4))
+
+
+def column(typ, values, body: bytearray):
+    header = {"column": typ, "count": len(values)}
+    if typ == 'bitmap':
+        bits = bytearray((len(values) + 7) // 8)
+        for i, v in enumerate(values):
+            if v:
+                bits[i >> 3] |= 1 << (i & 7)
+        body.extend(bits)
+    else:
+        if typ == 'delta':
+            header["base"] = values[0] if values else 0
+            data = array.array('I', [0] + [round(values[i] - values[i - 1]) for i in range(1, len(values))])
+        else:
+            data = array.array('f', [math.nan if v is None else v for v in values])
+        if sys.byteorder == 'big':
+            data.byteswap()
+        body.extend(data.tobytes())
+    pad(body)
+    return header
+
+
+def encode_value(value, body: bytearray):
+    if isinstance(value, dict):
+        return {k: column(column_types[k], v, body) if k in column_types and isinstance(v, list)
+                else encode_value(v, body) for k, v in value.items()}
+    if isinstance(value, list):
+        return [encode_value(i, body) for i in value]
+    return value
+
+
+def encode(data):
+    body = bytearray()
+    header = bytearray(json.dumps(encode_value(data, body)).encode())
+    header.extend(b' ' * (-len(header) % 4))
+    return struct.pack('<I', len(header)) + header + body
+
+
+def detail(data):
+    """Encode a detail series ({"time": [...], "avg": [...], ...})."""
+    return encode(data)
+
+
+def detail_nodes(data):
+    """Encode detail series of several nodes ({node: series})."""
+    if data is not None:
+        data = {"keys": list(data), "values": list(data.values())}
+    return encode(data)
+
+
+def glance(data):
+    """Encode glance series of every planet ([{"data": [{"stamp", "timeout", "avg"[, "timeouts"]}]}])."""
+    for node in data or ():
+        if node['data'] is not None:
+            node['data'] = {"rows": {i: [r[i] for r in node['data']] for i in ('stamp', 'timeout', 'avg', 'timeouts')
+                                     if node['data'] and i in node['data'][0]}}
+    return encode(data)
@@ -15,6 +15,83 @@ mtr_config = {
     "max_ttl": 30
 }
 
+# Names not found in node cache are rejected without asking database until the cache is this old.
+unknown_node_ttl = 60  # s
+
+ingest_config = {
+    "mode": "commit",  # "commit": acknowledge report after committed, "enqueue": after queued in memory
+    "max_size": 100000,  # reports held in memory at most
+    "flush_size": 1000,  # flush once this many reports queued
+    "flush_interval": 1,  # s
+}
+
+rollup_config = {
+    "resolutions": (5 * 60, 60 * 60),  # s, widths of rollup buckets, finest first
+    # Charts use the finest of raw records and rollups that shows the span in at most this many points.
+    "max_points": 2100,
+    "interval": 5 * 60,  # s, how often rollups are updated
+    "late": 5 * 60,  # s, records arriving later than this after their bucket ends may be left out
+}
+
+partition_config = {
+    "precreate": 2,  # months of record partitions created ahead
+    "retention": 0,  # months of records kept, including current one. 0 keeps records forever
+    "expire": "drop",  # "drop" or "detach" partitions out of retention
+    "interval": 24 * 60 * 60,  # s, how often partitions are maintained
+}
+
+# Public record APIs cache results for each ping window. A window's cache is dropped this
+# long after the window begins, when reports of it should have arrived.
+cache_config = {
+    "delay": 10,  # s
+    "size": 10000,  # entries at most
+}
+
+# Request rate limits of public APIs. A client may make `burst` requests at once,
+# then one more every `duration` seconds. Handlers sharing an entry are limited separately.
+rate_limits = {
+    "record": {"duration": 1, "burst": 1},  # s
+    "detail": {"duration": 3, "burst": 1},
+    "longterm": {"duration": 10, "burst": 1},
+    "detail_longterm": {"duration": 30, "burst": 1},
+    "detail_batch": {"duration": 3, "burst": 1},
+    "route": {"duration": 1, "burst": 1},
+    "route_range": {"duration": 3, "burst": 1},
+    "live": {"duration": 1, "burst": 1},
+    "matrix": {"duration": 1, "burst": 1},
+}
+
+# "memory": limits are kept by each process. "database": limits are kept in database and
+# hold across all processes, at the cost of a query per request.
+rate_limit_backend = "memory"
+
+# Tracing of database methods. Calls taking over `slow` seconds once connection acquired are logged
+# and kept for /admin/slow. For `explain` of them, the slowest SELECT run is explained with
+# EXPLAIN ANALYZE, running it again.
+trace_config = {
+    "enabled": False,
+    "slow": 0.5,  # s
+    "explain": 0.1,  # ratio of slow calls explained
+    "history": 100,  # slow calls kept
+}
+
+# Processes serving each server. 1 serves in the current process, 0 forks one for each CPU core.
+# With more than one process, use the "database" rate limit backend so limits hold across them.
+server_config = {
+    "debug": True,  # reload on code change, and don't cache templates, pages or static file hashes. Single process only
+    "web_workers": 1,
+    "report_workers": 1,
+    "pool_budget": 20,  # database connections shared by all processes of a server
+}
+
+# Keep the last `hours` of ping records of at most `targets` targets in memory of each web process,
+# answering recent chart queries without database. Takes about 42 KB per node and target a day.
+hot_window_config = {
+    "enabled": False,
+    "hours": 24,
+    "targets": 100,
+}
+
 
 def get_config():
     return {
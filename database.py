@@ -14,12 +14,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import contextlib
+import contextvars
 import functools
+import hashlib
+import ipaddress
+import datetime
 import asyncpg
 import json
+import random
 import time
 import config
-from collections import ChainMap
+import metrics
+from collections import ChainMap, deque
+from tornado.log import gen_log
+import tornado.process
 import credential
 
 
@@ -39,11 +49,475 @@ def round_mtr_time(t):
     return t / 1000000000 // config.mtr_config["frequency"] * config.mtr_config["frequency"]
 
 
+def to_datetime(stamp):
+    return datetime.datetime.fromtimestamp(stamp, datetime.timezone.utc)
+
+
+def is_count(v):
+    return isinstance(v, int) and not isinstance(v, bool) and 0 <= v <= 32767
+
+
+# Largest finite value of a real (float32) column.
+max_real = 3.4028234663852886e38
+
+
+def is_duration(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool) and 0 <= v <= max_real
+
+
+def ping_row(planet, p, names):
+    """Convert a ping report into a StarPing_PingData row, or return the reason it is refused.
+
+    names maps target ip to target name."""
+    try:
+        stat = p['report']['stat']
+        row = (planet, to_datetime(round_ping_time(p['time'])), names.get(ipaddress.ip_address(p['report']['ip'])),
+               stat['timeout'], stat['avg'], stat['min'], stat['max'], stat['std_dev'], stat['drop'], stat['total'])
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None, "Malformed report."
+    if row[2] is None:
+        return None, "Unknown target."
+    if not isinstance(row[3], bool) or not all(is_duration(i) for i in row[4:8]) \
+            or not is_count(row[8]) or not is_count(row[9]) or row[9] == 0:
+        return None, "Bad report value."
+    return row, None
+
+
+def route_fingerprint(hops):
+    """Fingerprint of the path of mtr hops, same for reports going through the same addresses.
+
+    The path is hops in order, each as its addresses sorted and joined by "|", or "*" if timed out,
+    joined by ",". Its fingerprint is the first 8 bytes of its md5 as a signed integer. Must stay
+    the same as starping_route_fingerprint of migrations/006_route_fingerprint.sql."""
+    path = ','.join('*' if hop['timeout'] else '|'.join(sorted(addr['ip'] for addr in hop['addr']))
+                    for hop in sorted(hops, key=lambda hop: hop['index']))
+    return int.from_bytes(hashlib.md5(path.encode()).digest()[:8], 'big', signed=True)
+
+
+# Columns of a StarPing_MTRData row, as made by mtr_row.
+mtr_columns = ('node', 'time', 'name', 'hop_count', 'fingerprint', 'hop_index', 'hop_timeout', 'hop_ip', 'hop_rdns',
+               'hop_code', 'hop_avg', 'hop_min', 'hop_max', 'hop_std_dev', 'hop_drop', 'hop_total', 'hop_extra',
+               'hop_extra_ip')
+
+
+def hop_columns(hops):
+    """Split mtr hops into hop_* column values: an array of each field, with the first address of each
+    hop, and further addresses in hop_extra as {position: [address, ...]}, or None if there is none.
+    hop_extra_ip has the ip of every further address, or None if there is none, to search routes by."""
+    columns = [[] for _ in range(11)]
+    extra = dict()
+    extra_ip = []
+    for position, hop in enumerate(hops):
+        addr = hop.get('addr') or []
+        first = addr[0] if addr else None
+        for column, value in zip(columns, (
+                hop['index'], hop['timeout'],
+                None if first is None else ipaddress.ip_address(first['ip']),
+                None if first is None else first['rdns'],
+                None if first is None else first['code'],
+                hop.get('avg'), hop.get('min'), hop.get('max'), hop.get('std_dev'), hop.get('drop'), hop.get('total'))):
+            column.append(value)
+        if len(addr) > 1:
+            extra[str(position)] = addr[1:]
+            extra_ip.extend(ipaddress.ip_address(i['ip']) for i in addr[1:])
+    return tuple(columns) + (json.dumps(extra) if extra else None, extra_ip or None)
+
+
+def mtr_row(node, p, names):
+    """Convert a mtr report into a StarPing_MTRData row, or return the reason it is refused.
+
+    names maps target ip to target name."""
+    try:
+        row = (node, to_datetime(round_mtr_time(p['time'])), names.get(ipaddress.ip_address(p['report']['ip'])),
+               p['report']['hop_count'], route_fingerprint(p['report']['stat'])) + hop_columns(p['report']['stat'])
+    except (KeyError, IndexError, AttributeError, TypeError, ValueError, OverflowError):
+        return None, "Malformed report."
+    if row[2] is None:
+        return None, "Unknown target."
+    if not is_count(row[3]) or not all(is_count(i) for i in row[5]) or not all(isinstance(i, bool) for i in row[6]) \
+            or not all(i is None or isinstance(i, str) for i in row[8]) \
+            or not all(i is None or is_count(i) for i in row[9] + row[14] + row[15]) \
+            or not all(i is None or is_duration(i) for i in row[10] + row[11] + row[12] + row[13]):
+        return None, "Bad report value."
+    return row, None
+
+
+def dedupe_rows(rows, rejected):
+    """Pair rows with their index, dropping rows that duplicate an earlier one's key."""
+    unique = dict()
+    for index, row in enumerate(rows):
+        if row[:3] in unique:
+            rejected.append((index, "Duplicate report."))
+        else:
+            unique[row[:3]] = index, row
+    return list(unique.values())
+
+
+async def store_rows(db, table, columns, statement, rows, rejected):
+    """Write rows in one transaction. If COPY is refused as a whole, fall back to
+    inserting row by row, each one under its own savepoint, so only offending rows are lost."""
+    if not rows:
+        return
+    async with db.transaction():
+        try:
+            async with db.transaction():
+                await db.copy_records_to_table(table, records=[row for _, row in rows], columns=columns)
+            return
+        except (asyncpg.PostgresError, ValueError, OverflowError):
+            # Encoding a row may fail on client side too, before anything is sent.
+            pass
+        for index, row in rows:
+            try:
+                async with db.transaction():
+                    await db.prepared(statement, 'fetch', *row)
+            except (asyncpg.PostgresError, ValueError, OverflowError):
+                rejected.append((index, "Bad report value."))
+
+
+def months(year, month, count):
+    """Yield (year, month) of `count` months from the given one. Negative count goes backwards."""
+    for _ in range(abs(count)):
+        yield year, month
+        month += 1 if count > 0 else -1
+        if month > 12:
+            year, month = year + 1, 1
+        elif month < 1:
+            year, month = year - 1, 12
+
+
+async def create_month_partition(db: asyncpg.Connection, parent, year, month):
+    """Create partition of `parent` holding records of a month (in UTC), named `parent`_YYYYMM."""
+    (year, month), (next_year, next_month) = months(year, month, 2)
+    await db.execute(f"CREATE TABLE IF NOT EXISTS {parent}_{year:04}{month:02} PARTITION OF {parent} "
+                     f"FOR VALUES FROM ('{year:04}-{month:02}-01 00:00:00+00') "
+                     f"TO ('{next_year:04}-{next_month:02}-01 00:00:00+00');")
+
+
+# Hops of a StarPing_MTRData row aliased d, in the form of mtr reports' stat.
+mtr_hops = ("(SELECT coalesce(jsonb_agg(jsonb_build_object("
+            "'index', h.index, 'timeout', h.timeout, "
+            "'addr', (CASE WHEN h.ip IS NULL THEN '[]'::jsonb ELSE jsonb_build_array(jsonb_build_object("
+            "'ip', host(h.ip), 'rdns', h.rdns, 'code', h.code)) END) || "
+            "coalesce(d.hop_extra->((h.n - 1)::text), '[]'::jsonb), "
+            "'avg', h.avg, 'min', h.min, 'max', h.max, 'std_dev', h.std_dev, 'drop', h.drop, 'total', h.total"
+            ") ORDER BY h.n), '[]'::jsonb) FROM unnest(d.hop_index, d.hop_timeout, d.hop_ip, d.hop_rdns, d.hop_code, "
+            "d.hop_avg, d.hop_min, d.hop_max, d.hop_std_dev, d.hop_drop, d.hop_total) WITH ORDINALITY "
+            "h(index, timeout, ip, rdns, code, avg, min, max, std_dev, drop, total, n))")
+
+# Statements on hot paths. Every connection of the pool prepares all of them once it
+# is established, so they are not parsed and planned again on each call, and a
+# reconnected connection gets them prepared again.
+statements = {
+    'get_ping_targets': 'select ip from StarPing_PingTargets where $1 = ANY(nodes) or $2 = ANY(nodes);',
+    'get_mtr_targets': 'select ip from StarPing_MTRTargets where $1 = ANY(nodes) or $2 = ANY(nodes);',
+    'insert_ping': 'insert into StarPing_PingData '
+                   '(node, time, name, timeout, avg, min, max, std_dev, drop, total) VALUES '
+                   '($1, $2, $3, $4, $5, $6, $7, $8, $9, $10);',
+    'insert_mtr': 'insert into StarPing_MTRData (node, time, name, hop_count, fingerprint, hop_index, hop_timeout, '
+                  'hop_ip, hop_rdns, hop_code, hop_avg, hop_min, hop_max, hop_std_dev, hop_drop, hop_total, hop_extra, '
+                  'hop_extra_ip) '
+                  'VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18);',
+    'ping_timespan': "SELECT json_build_object("
+                     "'time', json_agg(stamp),"
+                     "'timeout', json_agg(timeout),"
+                     "'avg', json_agg(avg),"
+                     "'min', json_agg(min),"
+                     "'max', json_agg(max),"
+                     "'std_dev', json_agg(std_dev),"
+                     "'drop', json_agg(drop),"
+                     "'total', json_agg(total),"
+                     "'step', $5::integer"
+                     ") FROM ("
+                     "SELECT extract(epoch from time) stamp, timeout, avg, min, max, std_dev, drop, total "
+                     "from StarPing_PingData where node = $1 and name = $2 and "
+                     "time > to_timestamp($3) and time <= to_timestamp($4) order by stamp"
+                     ") t;",
+    'ping_rollup_timespan': "SELECT json_build_object("
+                            "'time', json_agg(stamp),"
+                            "'timeout', json_agg(timeout),"
+                            "'avg', json_agg(avg),"
+                            "'min', json_agg(min),"
+                            "'max', json_agg(max),"
+                            "'std_dev', json_agg(std_dev),"
+                            "'drop', json_agg(drop),"
+                            "'total', json_agg(total),"
+                            "'timeouts', json_agg(timeouts),"
+                            "'step', $5::integer"
+                            ") FROM ("
+                            "SELECT extract(epoch from time) stamp, timeout_count = count timeout, "
+                            "timeout_count::real / count timeouts, avg, min, max, std_dev, drop, total "
+                            "from StarPing_PingRollup where resolution = $5 and node = $1 and name = $2 and "
+                            "time > to_timestamp($3) and time <= to_timestamp($4) order by stamp"
+                            ") t;",
+    # Detail series of several planets in one query, as {planet: series}. Planets without records are left out.
+    'ping_nodes_timespan': "SELECT json_object_agg(node, s) FROM (SELECT node, json_build_object("
+                           "'time', json_agg(stamp ORDER BY stamp),"
+                           "'timeout', json_agg(timeout ORDER BY stamp),"
+                           "'avg', json_agg(avg ORDER BY stamp),"
+                           "'min', json_agg(min ORDER BY stamp),"
+                           "'max', json_agg(max ORDER BY stamp),"
+                           "'std_dev', json_agg(std_dev ORDER BY stamp),"
+                           "'drop', json_agg(drop ORDER BY stamp),"
+                           "'total', json_agg(total ORDER BY stamp),"
+                           "'step', $5::integer"
+                           ") s FROM ("
+                           "SELECT node, extract(epoch from time) stamp, timeout, avg, min, max, std_dev, drop, total "
+                           "from StarPing_PingData where node = any($1::text[]) and name = $2 and "
+                           "time > to_timestamp($3) and time <= to_timestamp($4)"
+                           ") t GROUP BY node) g;",
+    'ping_nodes_rollup_timespan': "SELECT json_object_agg(node, s) FROM (SELECT node, json_build_object("
+                                  "'time', json_agg(stamp ORDER BY stamp),"
+                                  "'timeout', json_agg(timeout ORDER BY stamp),"
+                                  "'avg', json_agg(avg ORDER BY stamp),"
+                                  "'min', json_agg(min ORDER BY stamp),"
+                                  "'max', json_agg(max ORDER BY stamp),"
+                                  "'std_dev', json_agg(std_dev ORDER BY stamp),"
+                                  "'drop', json_agg(drop ORDER BY stamp),"
+                                  "'total', json_agg(total ORDER BY stamp),"
+                                  "'timeouts', json_agg(timeouts ORDER BY stamp),"
+                                  "'step', $5::integer"
+                                  ") s FROM ("
+                                  "SELECT node, extract(epoch from time) stamp, timeout_count = count timeout, "
+                                  "timeout_count::real / count timeouts, avg, min, max, std_dev, drop, total "
+                                  "from StarPing_PingRollup where resolution = $5 and node = any($1::text[]) and "
+                                  "name = $2 and time > to_timestamp($3) and time <= to_timestamp($4)"
+                                  ") t GROUP BY node) g;",
+    # Latest ping record of every (planet, target) since $1, served by main.LatestTable.
+    'ping_latest': "SELECT DISTINCT ON (node, name) node, name, extract(epoch from time)::float8 stamp, timeout, "
+                   "avg, drop, total from StarPing_PingData where time > to_timestamp($1) "
+                   "order by node, name, time desc;",
+    'pingavg_timespan': "select json_agg(s) from (select name, shown_name, (select json_agg(t) from ("
+                        "select extract(epoch from time) stamp, timeout, avg from "
+                        "StarPing_PingData where node = StarPing_Nodes.name and name = $1 "
+                        "and time > to_timestamp($2) and time <= to_timestamp($3) order by stamp"
+                        ") t) as data from StarPing_Nodes where type = 'planet') s;",
+    'pingavg_rollup_timespan': "select json_agg(s) from (select name, shown_name, (select json_agg(t) from ("
+                               "select extract(epoch from time) stamp, timeout_count = count timeout, "
+                               "timeout_count::real / count timeouts, avg from "
+                               "StarPing_PingRollup where resolution = $4 and node = StarPing_Nodes.name "
+                               "and name = $1 and time > to_timestamp($2) and time <= to_timestamp($3) "
+                               "order by stamp"
+                               ") t) as data from StarPing_Nodes where type = 'planet') s;",
+    # Take a token from a rate limit bucket, returning a row only if there was one.
+    'rate_limit': "insert into StarPing_RateLimit as r (endpoint, key, tokens, stamp, full_at) "
+                  "values ($1, $2, $4::float8 - 1, now(), now() + make_interval(secs => $3::float8)) "
+                  "on conflict (endpoint, key) do update set "
+                  "tokens = least($4::float8, r.tokens + extract(epoch from now() - r.stamp) / $3::float8) - 1, "
+                  "stamp = now(), "
+                  "full_at = now() + make_interval(secs => ($4::float8 - least($4::float8, r.tokens + "
+                  "extract(epoch from now() - r.stamp) / $3::float8) + 1) * $3::float8) "
+                  "where least($4::float8, r.tokens + extract(epoch from now() - r.stamp) / $3::float8) >= 1 "
+                  "returning true;",
+    'mtr_from': "select json_build_object('time', extract(epoch from d.time), 'data', " + mtr_hops + ") from ("
+                "SELECT * from StarPing_MTRData where node = $1 "
+                "and name = $2 and time > to_timestamp($3) order by time limit 1) d;",
+    # Series of a hop of records in (start, end], in the form of ping_timespan.
+    'mtr_hop_timespan': "SELECT json_build_object("
+                        "'time', json_agg(stamp),"
+                        "'timeout', json_agg(timeout),"
+                        "'avg', json_agg(avg),"
+                        "'min', json_agg(min),"
+                        "'max', json_agg(max),"
+                        "'std_dev', json_agg(std_dev),"
+                        "'drop', json_agg(drop),"
+                        "'total', json_agg(total),"
+                        "'step', $6::integer"
+                        ") FROM ("
+                        "SELECT extract(epoch from time) stamp, hop_timeout[i] timeout, hop_avg[i] avg, "
+                        "hop_min[i] min, hop_max[i] max, hop_std_dev[i] std_dev, hop_drop[i] drop, hop_total[i] total "
+                        "from (SELECT *, array_position(hop_index, $3::smallint) i from StarPing_MTRData "
+                        "where node = $1 and name = $2 and time > to_timestamp($4) and time <= to_timestamp($5)) d "
+                        "where i is not null order by stamp"
+                        ") t;",
+    # Nodes and targets of records since $2 whose route goes through address $1, as any address of a hop.
+    # Found by the hop_ip and hop_extra_ip indexes.
+    'mtr_through': "SELECT json_agg(json_build_object('node', node, 'target', name)) FROM ("
+                   "SELECT DISTINCT node, name from StarPing_MTRData "
+                   "where (hop_ip @> ARRAY[$1::inet] or hop_extra_ip @> ARRAY[$1::inet]) "
+                   "and time > to_timestamp($2)) t;",
+    # Records in (start, end] whose route differs from the record before, the first one included.
+    # Fingerprints are given in hex, as they don't fit in a javascript number.
+    'mtr_changes': "select json_agg(json_build_object('time', extract(epoch from t.time), "
+                   "'fingerprint', to_hex(t.fingerprint)) order by t.time) from ("
+                   "select time, fingerprint, lag(fingerprint) over (order by time) previous from StarPing_MTRData "
+                   "where node = $1 and name = $2 and time > to_timestamp($3) and time <= to_timestamp($4)"
+                   ") t where t.previous is distinct from t.fingerprint;",
+    'mtr_range': "select json_agg(json_build_object('time', extract(epoch from d.time), "
+                 "'fingerprint', to_hex(d.fingerprint), 'data', " + mtr_hops + ") order by d.time) from ("
+                 "select * from StarPing_MTRData where node = $1 and name = $2 "
+                 "and time > to_timestamp($3) and time <= to_timestamp($4) order by time desc limit $5) d;",
+    # Both keep the latest $5 records, in time order. Changes are found from the route index alone,
+    # then only their records are read.
+    'mtr_changes_range': "select json_agg(json_build_object('time', extract(epoch from c.time), "
+                         "'fingerprint', to_hex(c.fingerprint), 'data', " + mtr_hops + ") order by c.time) from ("
+                         "select time, fingerprint from (select time, fingerprint, "
+                         "lag(fingerprint) over (order by time) previous from StarPing_MTRData "
+                         "where node = $1 and name = $2 and time > to_timestamp($3) and time <= to_timestamp($4)"
+                         ") t where t.previous is distinct from t.fingerprint order by time desc limit $5"
+                         ") c join StarPing_MTRData d on d.node = $1 and d.name = $2 and d.time = c.time;",
+}
+
+
+# Aggregate ping records in [$2, $3) into rollup buckets $1 seconds wide. std_dev of a
+# bucket is pooled from records' avg and std_dev. Buckets already there are replaced, so
+# a bucket still filling can be aggregated again later.
+rollup_statement = (
+    "insert into StarPing_PingRollup "
+    "(resolution, node, name, time, count, timeout_count, avg, min, max, std_dev, drop, total) "
+    "select $1::integer, node, name, to_timestamp(floor(extract(epoch from time) / $1::integer) * $1::integer) bucket, "
+    "count(*), count(*) filter (where timeout), "
+    "coalesce(avg(avg) filter (where not timeout), 0), "
+    "coalesce(min(min) filter (where not timeout), 0), "
+    "coalesce(max(max) filter (where not timeout), 0), "
+    "coalesce(sqrt(greatest(avg(std_dev * std_dev + avg * avg) filter (where not timeout) "
+    "- avg(avg) filter (where not timeout) ^ 2, 0)), 0), "
+    "sum(drop), sum(total) "
+    "from StarPing_PingData where time >= to_timestamp($2) and time < to_timestamp($3) "
+    "group by node, name, bucket "
+    "on conflict (resolution, node, name, time) do update set "
+    "count = excluded.count, timeout_count = excluded.timeout_count, avg = excluded.avg, min = excluded.min, "
+    "max = excluded.max, std_dev = excluded.std_dev, drop = excluded.drop, total = excluded.total;")
+
+
+def ping_resolution(start, end):
+    """Pick the finest resolution showing [start, end] in at most max_points points,
+    or the coarsest one if none does. Raw records have resolution of ping frequency."""
+    resolutions = (config.ping_config["frequency"],) + tuple(config.rollup_config["resolutions"])
+    for resolution in resolutions:
+        if (end - start) / resolution <= config.rollup_config["max_points"]:
+            return resolution
+    return resolutions[-1]
+
+
+# (query, args, seconds) of queries run while a call is traced, or None if not traced.
+# Kept in context rather than on the connection, as pooled connections are proxies taking no new attribute.
+traced_queries = contextvars.ContextVar('traced_queries', default=None)
+
+
+@contextlib.contextmanager
+def traced(query, args):
+    """Record query to `traced_queries` once run, if traced. Done here rather than by query_logger of
+    asyncpg, which skips prepared statements and reports the others only after the call returned."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        queries = traced_queries.get()
+        if queries is not None:
+            queries.append((query, args, time.perf_counter() - start))
+
+
+class Connection(asyncpg.Connection):
+    async def prepare_statements(self):
+        self.statements = {name: await self.prepare(query) for name, query in statements.items()}
+
+    async def prepared(self, name, method, *args):
+        """Run prepared statement `name` with `method` (fetch, fetchrow, fetchval)."""
+        with traced(statements[name], args):
+            try:
+                return await getattr(self.statements[name], method)(*args)
+            except asyncpg.InvalidCachedStatementError:
+                # Schema changed under the statement. Prepare it again.
+                self.statements[name] = await self.prepare(statements[name])
+                return await getattr(self.statements[name], method)(*args)
+
+    async def execute(self, query, *args, **kwargs):
+        with traced(query, args):
+            return await super().execute(query, *args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        with traced(query, args):
+            return await super().fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        with traced(query, args):
+            return await super().fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        with traced(query, args):
+            return await super().fetchval(query, *args, **kwargs)
+
+
+pool_wait = metrics.Histogram('starping_db_pool_wait_seconds', 'Time waiting for a pooled database connection, '
+                                                               'by method.', ('method',))
+call_duration = metrics.Histogram('starping_db_call_seconds', 'Time running database methods once '
+                                                              'connection acquired, by method.', ('method',))
+pool_connections = metrics.Gauge('starping_db_pool_connections', 'Database connections of pool, by state.',
+                                 ('state',))
+
+
+def brief(value, limit=200):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+class Tracer:
+    """Trace database methods called through with_db and with_self_db, as configured in
+    `config.trace_config`. Calls slower than `slow` are logged and kept in `slow_calls`.
+    For a sample of them the slowest SELECT run is explained in background."""
+
+    def __init__(self, enabled=False, slow=0.5, explain=0.1, history=100):
+        self.enabled = enabled
+        self.slow = slow
+        self.explain_rate = explain
+        self.slow_calls = deque(maxlen=history)
+
+    async def call(self, database, db: Connection, name, args, kwargs, waited, run):
+        start = time.perf_counter()
+        if not self.enabled:
+            try:
+                return await run()
+            finally:
+                call_duration.observe(time.perf_counter() - start, name)
+        queries = []
+        token = traced_queries.set(queries)
+        try:
+            return await run()
+        finally:
+            traced_queries.reset(token)
+            elapsed = time.perf_counter() - start
+            call_duration.observe(elapsed, name)
+            if elapsed >= self.slow:
+                self.record(database, name, args, kwargs, waited, elapsed, queries)
+
+    def record(self, database, name, args, kwargs, waited, elapsed, queries):
+        call = {
+            "time": time.time(),
+            "method": name,
+            "args": brief(args),
+            "kwargs": brief(kwargs),
+            "wait": waited,
+            "duration": elapsed,
+            "queries": [{"query": query, "args": brief(args), "duration": seconds} for query, args, seconds in queries],
+            "plan": None,
+        }
+        self.slow_calls.append(call)
+        gen_log.warning(f"Slow database call {name}{call['args']} took {elapsed * 1000:.1f}ms "
+                        f"after waiting {waited * 1000:.1f}ms for connection.")
+        selects = [i for i in queries if i[0].lstrip().lower().startswith('select')]
+        if selects and random.random() < self.explain_rate:
+            query, args, _ = max(selects, key=lambda i: i[2])
+            asyncio.ensure_future(self.explain(database, call, query, args))
+
+    @staticmethod
+    async def explain(database, call, query, args):
+        # Only SELECTs are explained, as EXPLAIN ANALYZE runs the query again.
+        try:
+            async with database.pool.acquire() as db:
+                call["plan"] = '\n'.join(i[0] for i in await db.fetch(f"EXPLAIN (ANALYZE, BUFFERS) {query}", *args))
+        except (OSError, asyncpg.PostgresError) as e:
+            call["plan"] = f"Failed explaining: {e}"
+
+
 def with_db(async_func):
     @functools.wraps(async_func)
     async def _(self, *args, **kwargs):
+        start = time.perf_counter()
         async with self.pool.acquire() as db:
-            return await async_func(db, *args, **kwargs)
+            waited = time.perf_counter() - start
+            pool_wait.observe(waited, async_func.__name__)
+            return await self.tracer.call(self, db, async_func.__name__, args, kwargs, waited,
+                                          lambda: async_func(db, *args, **kwargs))
 
     return _
 
@@ -51,8 +525,12 @@ def with_db(async_func):
 def with_self_db(async_func):
     @functools.wraps(async_func)
     async def _(self, *args, **kwargs):
+        start = time.perf_counter()
         async with self.pool.acquire() as db:
-            return await async_func(self, db, *args, **kwargs)
+            waited = time.perf_counter() - start
+            pool_wait.observe(waited, async_func.__name__)
+            return await self.tracer.call(self, db, async_func.__name__, args, kwargs, waited,
+                                          lambda: async_func(self, db, *args, **kwargs))
 
     return _
 
@@ -77,37 +555,144 @@ def unpack(async_func):
     return _
 
 
+# Cache sections loaded by refresh_cache, in order, and those to rebuild when a table changes.
+cache_loaders = ('_get_node_list', '_get_ping_targets_list', '_get_mtr_targets_list',
+                 '_get_group_name', '_get_group_info')
+cache_sections = {
+    'starping_nodes': ('_get_node_list',),
+    'starping_pingtargets': ('_get_ping_targets_list', '_get_group_info'),
+    'starping_mtrtargets': ('_get_mtr_targets_list',),
+    'starping_l1targetgroup': ('_get_group_info',),
+    'starping_l2targetgroup': ('_get_group_name', '_get_group_info'),
+}
+
+
 class Database:
-    def __init__(self, *args, **kwargs):
-        self._pool = asyncpg.create_pool(*args, **kwargs)
+    def __init__(self, *args, pool_size=10, **kwargs):
+        self.rollup_progress = dict()
+        self.listeners = dict()
+        self.listen_db = None
+        self.stale_cache = set()
+        self.reloading = None
+        self.loading_nodes = None
+        # Bumped whenever cached nodes, targets or groups are reloaded.
+        self.cache_version = 0
+        self.tracer = Tracer(**config.trace_config)
+        self._login = args, kwargs
+        self._pool = asyncpg.create_pool(*args, min_size=pool_size, max_size=pool_size,
+                                         connection_class=Connection, init=Connection.prepare_statements, **kwargs)
 
     async def connect(self):
         self.pool = await self._pool
+        metrics.before_collect(self._collect_pool)
         await self.refresh_cache()
+        await self.listen('starping_config', self.invalidate_cache)
+
+    def _collect_pool(self):
+        idle = self.pool.get_idle_size()
+        pool_connections.set(self.pool.get_size() - idle, 'in_use')
+        pool_connections.set(idle, 'idle')
+        pool_connections.set(self.pool.get_max_size(), 'max')
+
+    async def listen(self, channel, callback):
+        """Call callback(payload) on every notification of channel.
+
+        Notifications are received on a dedicated connection, reconnected when lost. As
+        notifications may be missed meanwhile, callbacks are called with None after reconnected."""
+        if channel not in self.listeners:
+            self.listeners[channel] = []
+            if self.listen_db is not None:
+                await self.listen_db.add_listener(channel, self._notify)
+        self.listeners[channel].append(callback)
+        if self.listen_db is None:
+            await self._connect_listener()
+
+    async def _connect_listener(self):
+        args, kwargs = self._login
+        self.listen_db = await asyncpg.connect(*args, **kwargs)
+        self.listen_db.add_termination_listener(self._listener_lost)
+        for channel in self.listeners:
+            await self.listen_db.add_listener(channel, self._notify)
+
+    def _notify(self, db, pid, channel, payload):
+        for callback in self.listeners[channel]:
+            try:
+                callback(payload)
+            except Exception:
+                gen_log.exception(f"Failed handling notification on {channel}.")
+
+    def _listener_lost(self, db):
+        self.listen_db = None
+        asyncio.ensure_future(self._reconnect_listener())
+
+    async def _reconnect_listener(self):
+        while self.listen_db is None:
+            try:
+                await self._connect_listener()
+            except (OSError, asyncpg.PostgresError) as e:
+                gen_log.warning(f"Failed reconnecting notification listener: {e}")
+                await asyncio.sleep(5)
+        for channel in self.listeners:
+            self._notify(self.listen_db, None, channel, None)
 
     @with_self_db
     async def refresh_cache(self, db):
-        await self._get_node_list(db)
-        await self._get_ping_targets_list(db)
-        await self._get_mtr_targets_list(db)
-        await self._get_group_name(db)
-        await self._get_group_info(db)
+        for loader in cache_loaders:
+            await getattr(self, loader)(db)
+
+    def invalidate_cache(self, table):
+        """Rebuild cache sections of a changed table, or all of them if table is None or unknown.
+
+        Called on notifications of channel starping_config, sent by triggers of the tables.
+        Changes arriving while rebuilding are coalesced into one more rebuild."""
+        self.stale_cache.update(cache_sections.get(table, cache_loaders))
+        if self.reloading is None:
+            self.reloading = asyncio.ensure_future(self._reload_cache())
+
+    async def _reload_cache(self):
+        try:
+            while self.stale_cache:
+                loaders = [i for i in cache_loaders if i in self.stale_cache]
+                self.stale_cache.clear()
+                async with self.pool.acquire() as db:
+                    for loader in loaders:
+                        await getattr(self, loader)(db)
+        except (OSError, asyncpg.PostgresError) as e:
+            gen_log.warning(f"Failed rebuilding cache: {e}")
+            self.stale_cache.clear()
+        finally:
+            self.reloading = None
+
+    @with_self_db
+    async def announce_reload(self, db):
+        """Have every process rebuild its whole cache."""
+        await db.execute("SELECT pg_notify('starping_config', '');")
 
     async def _get_node_list(self, db: asyncpg.Connection):
         self.nodes = {i['name']: (i['secret'], i['type'], i['shown_name']) for i in
                       await db.fetch('select name, secret, type, shown_name from StarPing_Nodes;')}
+        self.nodes_loaded = time.monotonic()
+        # Bumped only once new data is in place, or a page rendered meanwhile would be kept under it.
+        self.cache_version += 1
 
     async def _get_ping_targets_list(self, db: asyncpg.Connection):
-        self.ping_targets = {i['name']: (i['shown_name'], i['nodes']) for i in
-                             await db.fetch('select name, shown_name, nodes from StarPing_PingTargets;')}
+        targets = await db.fetch('select name, shown_name, nodes, ip from StarPing_PingTargets;')
+        self.ping_targets = {i['name']: (i['shown_name'], i['nodes']) for i in targets}
+        # Reverse index to resolve reported ip. Addresses are compared as ipaddress objects
+        # so different text forms of a IPv6 address meet.
+        self.ping_target_ips = {ipaddress.ip_address(str(i['ip'])): i['name'] for i in targets}
+        self.cache_version += 1
 
     async def _get_mtr_targets_list(self, db: asyncpg.Connection):
-        self.mtr_targets = {i['name']: (i['shown_name'], i['nodes']) for i in
-                            await db.fetch('select name, shown_name, nodes from StarPing_MTRTargets;')}
+        targets = await db.fetch('select name, shown_name, nodes, ip from StarPing_MTRTargets;')
+        self.mtr_targets = {i['name']: (i['shown_name'], i['nodes']) for i in targets}
+        self.mtr_target_ips = {ipaddress.ip_address(str(i['ip'])): i['name'] for i in targets}
+        self.cache_version += 1
 
     async def _get_group_name(self, db: asyncpg.Connection):
         self.group_names = {i['name']: i['shown_name'] for i in
                             await db.fetch('select name, shown_name from StarPing_L2TargetGroup;')}
+        self.cache_version += 1
 
     async def _get_group_info(self, db: asyncpg.Connection):
         group_info = json.loads(await db.fetchval(
@@ -127,36 +712,71 @@ class Database:
                 ") s) q FROM StarPing_L1TargetGroup) p where p.q->>'child' != 'null') r;"))
         groups = {j['shown_name']: v2groups.intersection(j['child']) for i, j in ChainMap(*groups).items()}
         self.groups = {i: j for i, j in groups.items() if j}
+        self.cache_version += 1
 
-    @with_db
-    async def get_secret(db: asyncpg.Connection, name):
-        return await db.fetchrow(f"select secret, type from StarPing_Nodes where name = '{name}';")
+    async def get_secret(self, name):
+        """Get (secret, type) of a node, or None if no such node.
 
-    @with_db
-    async def get_target(db: asyncpg.Connection, name, typ='planet'):
-        return list(str(i['ip']) for i in await db.fetch(
-                f"select ip from StarPing_PingTargets where '{typ}' = ANY(nodes) or '{name}' = ANY(nodes);")), \
-               list(str(i['ip']) for i in await db.fetch(
-                       f"select ip from StarPing_MTRTargets where '{typ}' = ANY(nodes) or '{name}' = ANY(nodes);"))
+        Served from node cache. Names not in cache are considered unknown until the cache
+        is older than `config.unknown_node_ttl`, so a node list reload is done at most
+        once per ttl no matter how many unknown names are tried. Concurrent misses share one reload."""
+        node = self.nodes.get(name)
+        if node is None:
+            if time.monotonic() - self.nodes_loaded < config.unknown_node_ttl:
+                return None
+            if self.loading_nodes is None:
+                self.loading_nodes = asyncio.ensure_future(self._load_nodes())
+            # Shielded, so a cancelled request does not cancel the reload others are waiting on.
+            await asyncio.shield(self.loading_nodes)
+            node = self.nodes.get(name)
+            if node is None:
+                return None
+        return node[0], node[1]
+
+    async def _load_nodes(self):
+        try:
+            async with self.pool.acquire() as db:
+                await self._get_node_list(db)
+        finally:
+            self.loading_nodes = None
 
     @with_db
-    async def ping_record(db: asyncpg.Connection, planet, p):
-        await db.execute("insert into StarPing_PingData "
-                         "(node, time, name, timeout, avg, min, max, std_dev, drop, total) VALUES "
-                         f"('{planet}', to_timestamp({round_ping_time(p['time'])}), "
-                         f"(select name from StarPing_PingTargets where ip = '{p['report']['ip']}'), "
-                         f"{p['report']['stat']['timeout']}, {p['report']['stat']['avg']}, "
-                         f"{p['report']['stat']['min']}, {p['report']['stat']['max']}, "
-                         f"{p['report']['stat']['std_dev']}, {p['report']['stat']['drop']}, "
-                         f"{p['report']['stat']['total']});")
+    async def get_target(db: Connection, name, typ='planet'):
+        return list(str(i['ip']) for i in await db.prepared('get_ping_targets', 'fetch', typ, name)), \
+               list(str(i['ip']) for i in await db.prepared('get_mtr_targets', 'fetch', typ, name))
+
+    def parse_ping(self, planet, p):
+        return ping_row(planet, p, self.ping_target_ips)
+
+    def parse_mtr(self, node, p):
+        return mtr_row(node, p, self.mtr_target_ips)
+
+    @with_self_db
+    async def ping_record(self, db: Connection, planet, p):
+        row, err = self.parse_ping(planet, p)
+        if err is None:
+            await db.prepared('insert_ping', 'fetch', *row)
+        return err
+
+    @with_self_db
+    async def mtr_record(self, db: Connection, planet, p):
+        row, err = self.parse_mtr(planet, p)
+        if err is None:
+            await db.prepared('insert_mtr', 'fetch', *row)
+        return err
 
     @with_db
-    async def mtr_record(db: asyncpg.Connection, planet, p):
-        await db.execute("insert into StarPing_MTRData "
-                         "(node, time, name, hop_count, data) VALUES "
-                         f"('{planet}', to_timestamp({round_mtr_time(p['time'])}), "
-                         f"(select name from StarPing_MTRTargets where ip = '{p['report']['ip']}'), "
-                         f"{p['report']['hop_count']}, '{json.dumps(p['report']['stat'])}');")
+    async def store_reports(db: Connection, ping_rows, mtr_rows):
+        """Store rows made by parse_ping and parse_mtr in bulk.
+
+        Returns lists of (index, reason) for ping and mtr rows refused."""
+        ping_rejected, mtr_rejected = [], []
+        await store_rows(db, 'starping_pingdata',
+                         ('node', 'time', 'name', 'timeout', 'avg', 'min', 'max', 'std_dev', 'drop', 'total'),
+                         'insert_ping', dedupe_rows(ping_rows, ping_rejected), ping_rejected)
+        await store_rows(db, 'starping_mtrdata', mtr_columns,
+                         'insert_mtr', dedupe_rows(mtr_rows, mtr_rejected), mtr_rejected)
+        return sorted(ping_rejected), sorted(mtr_rejected)
 
     @with_self_db
     async def add_new_node(self, db: asyncpg.Connection, name, secret, typ, sname=None):
@@ -172,10 +792,12 @@ class Database:
                 raise RuntimeError(f'A {exist} named "{name}" already exists.')
             await db.execute(f"INSERT INTO StarPing_Nodes (name, secret, type, shown_name) "
                              f"VALUES ('{name}', '{secret}', '{typ}', '{sname}');")
-            await db.execute(
-                    f"CREATE TABLE StarPing_PingData_{name} PARTITION OF StarPing_PingData FOR VALUES IN ('{name}');")
-            await db.execute(
-                    f"CREATE TABLE StarPing_MTRData_{name} PARTITION OF StarPing_MTRData FOR VALUES IN ('{name}');")
+            now = datetime.datetime.now(datetime.timezone.utc)
+            for table in ('StarPing_PingData', 'StarPing_MTRData'):
+                await db.execute(f"CREATE TABLE {table}_{name} PARTITION OF {table} FOR VALUES IN ('{name}') "
+                                 "PARTITION BY RANGE (time);")
+                for year, month in months(now.year, now.month, config.partition_config["precreate"] + 1):
+                    await create_month_partition(db, f'{table}_{name}', year, month)
         # Refresh node list cache.
         await self._get_node_list(db)
 
@@ -255,33 +877,88 @@ class Database:
             sname = name
         await db.execute(f"INSERT INTO StarPing_L1TargetGroup (name, sname) VALUES ('{name}', '{sname}')")
 
+    @with_self_db
+    async def update_rollup(self, db: Connection):
+        """Aggregate new ping records into rollup buckets. Meant to be called periodically.
+
+        Buckets from where the last call left are aggregated again, so records arriving up to
+        `late` seconds after their bucket ends are still counted."""
+        now = time.time()
+        for resolution in config.rollup_config["resolutions"]:
+            start = self.rollup_progress.get(resolution)
+            if start is None:
+                # Continue from the last bucket, or aggregate all existing records if there is none.
+                start = await db.fetchval(
+                        "select extract(epoch from coalesce(max(time), (select min(time) from StarPing_PingData))) "
+                        "from StarPing_PingRollup where resolution = $1;", resolution)
+                if start is None:
+                    start = now
+            start = start // resolution * resolution
+            # Catch up at most a day of records per statement.
+            while start < now:
+                end = min(start + 86400, now)
+                await db.execute(rollup_statement, resolution, start, end)
+                start = end
+            self.rollup_progress[resolution] = (now - config.rollup_config["late"]) // resolution * resolution
+
+    @with_self_db
+    async def maintain_partitions(self, db: asyncpg.Connection):
+        """Create monthly partitions of records ahead of time, and drop (or detach) the ones
+        older than retention. Meant to be called periodically."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        retention = config.partition_config["retention"]
+        # Months before this one are out of retention.
+        oldest = list(months(now.year, now.month, -retention))[-1] if retention else None
+        partitioned = {i['relname'] for i in await db.fetch(
+                "select relname from pg_class join pg_partitioned_table on oid = partrelid;")}
+        for node in self.nodes:
+            for table in ('StarPing_PingData', 'StarPing_MTRData'):
+                parent = f'{table}_{node}'
+                if parent.lower() not in partitioned:
+                    # Node created before records were partitioned by time. See migrations/002_time_partitions.sql.
+                    continue
+                for year, month in months(now.year, now.month, config.partition_config["precreate"] + 1):
+                    await create_month_partition(db, parent, year, month)
+                if oldest is None:
+                    continue
+                for child in await db.fetch("select c.relname from pg_inherits join pg_class c on c.oid = inhrelid "
+                                            "join pg_class p on p.oid = inhparent where p.relname = $1;",
+                                            parent.lower()):
+                    suffix = child['relname'].rsplit('_', 1)[-1]
+                    if not suffix.isdigit() or len(suffix) != 6 or (int(suffix[:4]), int(suffix[4:])) >= oldest:
+                        continue
+                    if config.partition_config["expire"] == 'detach':
+                        await db.execute(f"ALTER TABLE {parent} DETACH PARTITION {child['relname']};")
+                    else:
+                        await db.execute(f"DROP TABLE {child['relname']};")
+
+    @with_db
+    async def rate_limit(db: Connection, endpoint, key, duration, burst):
+        return await db.prepared('rate_limit', 'fetchval', endpoint, key, float(duration), float(burst)) is not None
+
+    @with_db
+    async def expire_rate_limits(db: Connection):
+        await db.execute("delete from StarPing_RateLimit where full_at < now();")
+
     # ----------
     # Functions above are considered safe as they are called by either the admin or the nodes.
-    # Functions below are serving queries.sql from website users and should be designed carefully
-    # to prevent SQL injection vulnerabilities.
+    # Functions below are serving queries from website users. Values must only reach database
+    # as parameters of statements in `statements`.
     # ----------
 
     def check_planet(self, planet):
-        if unsafe(planet):
-            return "Unsafe query."
         if planet not in self.nodes or self.nodes[planet][1] != 'planet':
             return "Non-exist planet."
 
     def check_comet(self, comet):
-        if unsafe(comet):
-            return "Unsafe query."
         if comet not in self.nodes or self.nodes[comet][1] != 'comet':
             return "Non-exist comet."
 
     def check_node(self, node):
-        if unsafe(node):
-            return "Unsafe query."
         if node not in self.nodes:
             return "Non-exist node."
 
     def check_pingtarget(self, target):
-        if unsafe(target):
-            return "Unsafe query."
         if target not in self.ping_targets:
             return "Non-exist target."
 
@@ -294,7 +971,7 @@ class Database:
             return "Bad time range."
 
     @with_self_db
-    async def _query_ping_timespan(self, db: asyncpg.Connection, planet, target, start, end):
+    async def _query_ping_timespan(self, db: Connection, planet, target, start, end):
         # parameter safety check
         err = self.check_planet(planet)
         if err is not None:
@@ -306,20 +983,10 @@ class Database:
         if err is not None:
             return None, err
 
-        return await db.fetchval("SELECT json_build_object("
-                                 "'time', json_agg(stamp),"
-                                 "'timeout', json_agg(timeout),"
-                                 "'avg', json_agg(avg),"
-                                 "'min', json_agg(min),"
-                                 "'max', json_agg(max),"
-                                 "'std_dev', json_agg(std_dev),"
-                                 "'drop', json_agg(drop),"
-                                 "'total', json_agg(total)"
-                                 ") FROM ("
-                                 "SELECT extract(epoch from time) stamp, timeout, avg, min, max, std_dev, drop, total "
-                                 f"from StarPing_PingData where node = '{planet}' and name = '{target}' and "
-                                 f"time > to_timestamp({start}) and time <= to_timestamp({end}) order by stamp"
-                                 ") t;"), None
+        resolution = ping_resolution(start, end)
+        if resolution == config.ping_config["frequency"]:
+            return await db.prepared('ping_timespan', 'fetchval', planet, target, start, end, resolution), None
+        return await db.prepared('ping_rollup_timespan', 'fetchval', planet, target, start, end, resolution), None
 
     # @with_self_db
     # async def query_ping_latest(self, db: asyncpg.Connection, planet, target):
@@ -345,7 +1012,7 @@ class Database:
 
     @unpack
     async def query_ping_timespan(self, planet, target, start, end):
-        return await self._query_ping_timespan(planet, target, start, end)
+        return await self._query_ping_timespan(planet, target, float(start), float(end))
 
     @unpack
     async def query_ping_from(self, planet, target, stamp):
@@ -355,20 +1022,60 @@ class Database:
             return None, "Bad time."
         return await self._query_ping_timespan(planet, target, stamp, now)
 
+    def target_planets(self, target):
+        """Planets pinging a target."""
+        nodes = self.ping_targets[target][1]
+        return [name for name, (_, typ, _) in self.nodes.items()
+                if typ == 'planet' and ('planet' in nodes or name in nodes)]
+
     @with_self_db
-    async def _query_pingavg_timespan(self, db: asyncpg.Connection, target, start, end):
+    async def _query_ping_nodes_timespan(self, db: Connection, planets, target, start, end):
         # parameter safety check
         err = self.check_pingtarget(target)
         if err is not None:
             return None, err
+        if planets is None:
+            planets = self.target_planets(target)
+        for planet in planets:
+            err = self.check_planet(planet)
+            if err is not None:
+                return None, err
         err = self.check_time(start, end)
         if err is not None:
             return None, err
-        return await db.fetchval("select json_agg(s) from (select name, shown_name, (select json_agg(t) from ("
-                                 "select extract(epoch from time) stamp, timeout, avg from "
-                                 f"StarPing_PingData where node = StarPing_Nodes.name and name = '{target}' "
-                                 f"and time > to_timestamp({start}) and time <= to_timestamp({end}) order by stamp"
-                                 ") t) as data from StarPing_Nodes where type = 'planet') s;"), None
+
+        resolution = ping_resolution(start, end)
+        if resolution == config.ping_config["frequency"]:
+            return await db.prepared('ping_nodes_timespan', 'fetchval',
+                                     planets, target, start, end, resolution) or '{}', None
+        return await db.prepared('ping_nodes_rollup_timespan', 'fetchval',
+                                 planets, target, start, end, resolution) or '{}', None
+
+    async def query_ping_nodes_hours(self, planets, target, hours):
+        """Detail series of several planets, or all planets pinging target if planets is None."""
+        if hours <= 0:
+            return None, "Bad time."
+        now = time.time()
+        return await self._query_ping_nodes_timespan(planets, target, now - 3600 * hours, now)
+
+    @with_self_db
+    async def query_ping_latest(self, db: Connection, since):
+        """Latest ping record of each node and target, of those newer than since."""
+        return await db.prepared('ping_latest', 'fetch', since)
+
+    @with_self_db
+    async def _query_pingavg_timespan(self, db: Connection, target, start, end):
+        # parameter safety check
+        err = self.check_pingtarget(target)
+        if err is not None:
+            return None, err
+        err = self.check_time(start, end)
+        if err is not None:
+            return None, err
+        resolution = ping_resolution(start, end)
+        if resolution == config.ping_config["frequency"]:
+            return await db.prepared('pingavg_timespan', 'fetchval', target, start, end), None
+        return await db.prepared('pingavg_rollup_timespan', 'fetchval', target, start, end, resolution), None
 
     @unpack
     async def query_pingavg_hours(self, target, hours):
@@ -379,7 +1086,7 @@ class Database:
 
     @unpack
     async def query_pingavg_timespan(self, target, start, end):
-        return await self._query_pingavg_timespan(target, start, end)
+        return await self._query_pingavg_timespan(target, float(start), float(end))
 
     @unpack
     async def query_pingavg_from(self, target, stamp):
@@ -390,7 +1097,7 @@ class Database:
         return await self._query_pingavg_timespan(target, stamp, now)
 
     @with_self_db
-    async def _query_mtr_from(self, db: asyncpg.Connection, node, target, stamp):
+    async def _query_mtr_from(self, db: Connection, node, target, stamp):
         # parameter safety check
         err = self.check_node(node)
         if err is not None:
@@ -398,9 +1105,7 @@ class Database:
         err = self.check_pingtarget(target)
         if err is not None:
             return None, err
-        return await db.fetchval("select json_build_object('time', t.stamp, 'data', t.data) from (SELECT\n"
-                                 f"extract(epoch from time) stamp, data from StarPing_MTRData where node = '{node}'\n"
-                                 f"and name = '{target}' and time > to_timestamp({stamp}) order by time limit 1) t;"), None
+        return await db.prepared('mtr_from', 'fetchval', node, target, stamp), None
 
     @unpack
     async def query_mtr_from(self, node, target, stamp):
@@ -410,8 +1115,64 @@ class Database:
             return None, "Bad time."
         return await self._query_mtr_from(node, target, stamp)
 
+    @with_self_db
+    async def _query_mtr_timespan(self, db: Connection, node, target, start, end, statement, *args):
+        # parameter safety check
+        err = self.check_node(node)
+        if err is not None:
+            return None, err
+        err = self.check_pingtarget(target)
+        if err is not None:
+            return None, err
+        err = self.check_time(start, end)
+        if err is not None:
+            return None, err
+        return await db.prepared(statement, 'fetchval', node, target, start, end, *args) or '[]', None
+
+    @unpack
+    async def query_mtr_changes(self, node, target, start, end):
+        """Times the route changed in (start, end], with the route fingerprint from then on."""
+        return await self._query_mtr_timespan(node, target, float(start), float(end), 'mtr_changes')
+
+    @unpack
+    async def query_mtr_range(self, node, target, start, end, changes=False, limit=100):
+        """Records in (start, end], the latest limit of them, or only those at route changes if changes."""
+        return await self._query_mtr_timespan(node, target, float(start), float(end),
+                                              'mtr_changes_range' if changes else 'mtr_range', limit)
+
+    @with_self_db
+    async def query_mtr_hop(self, db: Connection, node, target, hop, start, end):
+        """Series of hop `hop` of records in (start, end], in the form of query_ping_timespan."""
+        # parameter safety check
+        err = self.check_node(node)
+        if err is not None:
+            return None, err
+        err = self.check_pingtarget(target)
+        if err is not None:
+            return None, err
+        err = self.check_time(start, end)
+        if err is not None:
+            return None, err
+        if not is_count(hop):
+            return None, "Bad hop."
+        return await db.prepared('mtr_hop_timespan', 'fetchval', node, target, hop, start, end,
+                                 config.mtr_config["frequency"]), None
+
+    @with_self_db
+    async def query_mtr_through(self, db: Connection, ip, since):
+        """Nodes and targets whose route went through address ip since stamp."""
+        return await db.prepared('mtr_through', 'fetchval', ipaddress.ip_address(ip), since) or '[]', None
+
+
+def pool_size(workers):
+    """Connections each of `workers` processes may open within the connection budget.
+
+    One connection of each process is kept for notifications."""
+    workers = workers or tornado.process.cpu_count()
+    return max(config.server_config["pool_budget"] // workers - 1, 1)
+
 
-async def get_db():
-    database = Database(**credential.database_login)
+async def get_db(pool_size=10):
+    database = Database(pool_size=pool_size, **credential.database_login)
     await database.connect()
     return database
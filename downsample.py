@@ -0,0 +1,100 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Reduce chart series to a number of points with Largest-Triangle-Three-Buckets,
+# while making sure timeouts and packet loss are not smoothed away.
+
+
+def lttb(xs, ys, points, important=None):
+    """Pick at most `points` points of the series with LTTB.
+
+    Returns a list of (index, (lo, hi)): the picked point, and the range of points it stands
+    for. If `important` is given, it is called with a point index and returns a priority. In a
+    bucket having any point of positive priority, the point of highest priority is picked
+    instead of the one LTTB would pick."""
+    n = len(xs)
+    if points >= n or points < 3:
+        return [(i, (i, i + 1)) for i in range(n)]
+    every = (n - 2) / (points - 2)
+    ranges = [(0, 1)] + [(int(i * every) + 1, int((i + 1) * every) + 1) for i in range(points - 2)] + [(n - 1, n)]
+    picked = [(0, ranges[0])]
+    for k in range(1, len(ranges) - 1):
+        lo, hi = ranges[k]
+        if important is not None:
+            best = max(range(lo, hi), key=important)
+            if important(best) > 0:
+                picked.append((best, ranges[k]))
+                continue
+        nlo, nhi = ranges[k + 1]
+        next_x = sum(xs[nlo:nhi]) / (nhi - nlo)
+        next_y = sum(ys[nlo:nhi]) / (nhi - nlo)
+        last_x, last_y = xs[picked[-1][0]], ys[picked[-1][0]]
+        best = max(range(lo, hi),
+                   key=lambda i: abs((last_x - next_x) * (ys[i] - last_y) - (last_x - xs[i]) * (next_y - last_y)))
+        picked.append((best, ranges[k]))
+    picked.append((n - 1, ranges[-1]))
+    return picked
+
+
+def loss(drop, total):
+    def _(i):
+        return drop[i] / total[i] if drop[i] and total[i] else 0
+
+    return _
+
+
+def detail(data, points):
+    """Downsample a detail series ({"time": [...], "avg": [...], ...}).
+
+    avg and std_dev come from the picked point. min and max are the envelope of the points
+    it stands for. A timed out point is always picked over others, then the point losing
+    the most packets."""
+    if data.get('time') is None or len(data['time']) <= points:
+        return data
+    ys = [i or 0 for i in data['avg']]
+    lost = loss(data['drop'], data['total'])
+    # Share of records timed out in a rollup bucket, absent in raw records.
+    timeouts = data.get('timeouts') or [0] * len(data['time'])
+    result = {i: [] for i in data if isinstance(data[i], list)}
+    for index, (lo, hi) in lttb(data['time'], ys, points,
+                                lambda i: 2 if data['timeout'][i] else max(timeouts[i] or 0, lost(i))):
+        for i in result:
+            result[i].append(data[i][index])
+        alive = [i for i in range(lo, hi) if not data['timeout'][i]]
+        if alive and not data['timeout'][index]:
+            result['min'][-1] = min(data['min'][i] for i in alive)
+            result['max'][-1] = max(data['max'][i] for i in alive)
+    for i in data:
+        if i not in result:
+            result[i] = data[i]
+    return result
+
+
+def detail_nodes(data, points):
+    """Downsample detail series of several nodes ({node: series})."""
+    return {node: detail(series, points) for node, series in data.items()}
+
+
+def glance(data, points):
+    """Downsample every planet's series of a glance chart ([{"data": [{"stamp", "timeout", "avg"}]}])."""
+    for node in data or ():
+        series = node['data']
+        if series is None or len(series) <= points:
+            continue
+        node['data'] = [series[i] for i, _ in lttb([i['stamp'] for i in series], [i['avg'] or 0 for i in series],
+                                                    points, lambda i: 1 if series[i]['timeout'] else
+                                                    series[i].get('timeouts') or 0)]
+    return data
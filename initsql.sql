@@ -36,6 +36,7 @@ CREATE TABLE StarPing_MTRTargets (
 CREATE INDEX StarPing_MTRTargets_IPIndex ON StarPing_MTRTargets (ip);
 
 -- we don't store ip directly but store target name, to support target ip change without modifying existing records.
+-- Records are partitioned by node, and each node's partition by month of time. See Database.add_new_node.
 CREATE TABLE StarPing_PingData (
     node text REFERENCES StarPing_Nodes(name) ON DELETE CASCADE, -- disallow record with non-exist node
     time timestamptz NOT NULL,
@@ -52,16 +53,81 @@ CREATE TABLE StarPing_PingData (
 
 CREATE INDEX StarPing_PingData_Index ON StarPing_PingData(name, time);
 
+-- Announce every new ping record on channel starping_ping, for live chart updates.
+CREATE FUNCTION starping_notify_ping() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('starping_ping', json_build_object(
+        'node', NEW.node, 'name', NEW.name, 'stamp', extract(epoch from NEW.time), 'timeout', NEW.timeout,
+        'avg', NEW.avg, 'min', NEW.min, 'max', NEW.max, 'std_dev', NEW.std_dev, 'drop', NEW.drop, 'total', NEW.total
+    )::text);
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER StarPing_PingData_Notify AFTER INSERT ON StarPing_PingData
+    FOR EACH ROW EXECUTE FUNCTION starping_notify_ping();
+
+-- Ping records aggregated into buckets of `resolution` seconds, serving charts over long spans.
+-- count is number of records in the bucket and timeout_count number of them timed out.
+-- avg, min, max and std_dev are over records not timed out, drop and total are summed.
+CREATE TABLE StarPing_PingRollup (
+    resolution integer NOT NULL,
+    node text REFERENCES StarPing_Nodes(name) ON DELETE CASCADE,
+    name text REFERENCES StarPing_PingTargets(name) ON DELETE CASCADE,
+    time timestamptz NOT NULL, -- start of bucket
+    count smallint NOT NULL,
+    timeout_count smallint NOT NULL,
+    avg real,
+    min real,
+    max real,
+    std_dev real,
+    drop integer,
+    total integer,
+    PRIMARY KEY (resolution, node, name, time)
+);
+
 CREATE TABLE StarPing_MTRData (
     node text REFERENCES StarPing_Nodes(name) ON DELETE CASCADE,
     time timestamptz NOT NULL,
     name text REFERENCES StarPing_MTRTargets(name) ON DELETE CASCADE,
     hop_count smallint CHECK ( hop_count >= 0 ),
-    data jsonb,
+    fingerprint bigint, -- of the route, see database.route_fingerprint
+    -- Hops reported, each field an array of a value per hop. Only the first address of a hop is in
+    -- hop_ip, hop_rdns and hop_code. Further ones are in hop_extra, as {position from 0: [address, ...]}.
+    -- See database.hop_columns.
+    hop_index smallint[],
+    hop_timeout bool[],
+    hop_ip inet[],
+    hop_rdns text[],
+    hop_code smallint[],
+    hop_avg real[],
+    hop_min real[],
+    hop_max real[],
+    hop_std_dev real[],
+    hop_drop smallint[],
+    hop_total smallint[],
+    hop_extra jsonb,
+    hop_extra_ip inet[], -- ip of every address in hop_extra
     PRIMARY KEY (node, time, name)
 ) PARTITION BY LIST (node);
 
 CREATE INDEX StarPing_MTRData_Index ON StarPing_MTRData(name, time);
+-- Route changes of a node and target are found from this index alone.
+CREATE INDEX StarPing_MTRData_Route_Index ON StarPing_MTRData(node, name, time) INCLUDE (fingerprint);
+-- Routes going through an address, as hop_ip @> ARRAY[address] or hop_extra_ip @> ARRAY[address].
+CREATE INDEX StarPing_MTRData_IP_Index ON StarPing_MTRData USING gin (hop_ip);
+CREATE INDEX StarPing_MTRData_Extra_IP_Index ON StarPing_MTRData USING gin (hop_extra_ip);
+
+-- Token buckets of request rate limits, when shared by all processes. See config.rate_limit_backend.
+-- A bucket is full again at full_at and can be forgotten after that.
+CREATE UNLOGGED TABLE StarPing_RateLimit (
+    endpoint text NOT NULL,
+    key text NOT NULL,
+    tokens real NOT NULL,
+    stamp timestamptz NOT NULL,
+    full_at timestamptz NOT NULL,
+    PRIMARY KEY (endpoint, key)
+);
 
 CREATE TABLE StarPing_L1TargetGroup (
     name text PRIMARY KEY NOT NULL,
@@ -74,6 +140,26 @@ CREATE TABLE StarPing_L2TargetGroup (
     parent text REFERENCES StarPing_L1TargetGroup(name) ON DELETE CASCADE DEFAULT 'default'
 );
 
+-- Announce changes of nodes, targets and groups on channel starping_config, with the name of table
+-- changed, so every process rebuilds its cache of that table. See Database.invalidate_cache.
+CREATE FUNCTION starping_notify_config() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('starping_config', TG_TABLE_NAME);
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER StarPing_Nodes_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_Nodes
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+CREATE TRIGGER StarPing_PingTargets_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_PingTargets
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+CREATE TRIGGER StarPing_MTRTargets_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_MTRTargets
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+CREATE TRIGGER StarPing_L1TargetGroup_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_L1TargetGroup
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+CREATE TRIGGER StarPing_L2TargetGroup_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_L2TargetGroup
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+
 create or replace function drop_array_item(array1 anyarray, item text)
 returns anyarray language sql immutable as $$
     select coalesce(array_agg(elem), '{}')
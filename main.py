@@ -14,76 +14,252 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import array
 import asyncio
+import collections
 import platform
 import functools
 import time
-import ipaddress
+import json
+import math
+import gzip
+import hashlib
 
 import tornado.ioloop
 import tornado.web
 import tornado.httpserver
+import tornado.iostream
 import tornado.template
+import tornado.netutil
+import tornado.process
 from tornado.log import enable_pretty_logging
+try:
+    import brotli
+except ImportError:
+    brotli = None
+import config
 import database
+import downsample
+import columnar
+import ratelimit
+import metrics
 
 enable_pretty_logging()
 
+rate_limited = metrics.Counter('starping_rate_limited_total', 'Requests refused by rate limit, by endpoint.',
+                               ('endpoint',))
+cache_lookups = metrics.Counter('starping_cache_lookups_total',
+                                'Lookups of response and page caches. "shared" joined a query running for '
+                                'another request.', ('cache', 'result'))
 
-def limit_request(duration=1):
+
+def limit_request(endpoint):
+    """Limit request rate of each client to the endpoint as configured in `config.rate_limits`.
+
+    Every decorated handler has buckets of its own, with either backend, also when handlers share a setting."""
     def _(async_func):
-        v4map = dict()
-        v6map = dict()
+        limiter = ratelimit.backends[config.rate_limit_backend](f'{endpoint}/{async_func.__qualname__}',
+                                                               **config.rate_limits[endpoint])
 
         @functools.wraps(async_func)
         async def _(self: tornado.web.RequestHandler, *args, **kwargs):
-            nonlocal v4map
-            nonlocal v6map
-            addr = ipaddress.ip_address(self.request.remote_ip)
-            now = time.time()
-            if isinstance(addr, ipaddress.IPv4Address):
-                v4map = {i: j for i, j in v4map.items() if j > now}
-                if addr not in v4map:
-                    v4map[addr] = time.time() + duration
-                    return await async_func(self, *args, **kwargs)
-                else:
-                    self.set_status(429)
-                    await self.finish()
-            elif isinstance(addr, ipaddress.IPv6Address):
-                v6map = {i: j for i, j in v6map.items() if j > now}
-                net = ipaddress.ip_interface(self.request.remote_ip + '/64').network
-                if net not in v6map:
-                    v6map[net] = time.time() + duration
-                    return await async_func(self, *args, **kwargs)
-                else:
-                    self.set_status(429)
-                    await self.finish()
+            if await limiter.allow(ratelimit.client_key(self.request.remote_ip), self.settings['db']):
+                return await async_func(self, *args, **kwargs)
+            rate_limited.inc(endpoint)
+            self.set_status(429)
+            await self.finish()
 
         return _
 
     return _
 
 
+def get_points(handler: tornado.web.RequestHandler):
+    """Get optional `points` argument, the most points a series should be downsampled to."""
+    if 'points' not in handler.request.arguments:
+        return None
+    points = int(handler.request.arguments['points'][0])
+    if points < 3:
+        raise ValueError("Too few points.")
+    return points
+
+
+def get_stamp(handler: tornado.web.RequestHandler):
+    """Get `stamp` argument rounded down to ping frequency.
+
+    Records are stored at multiples of ping frequency, so querying after the rounded
+    stamp gives the same records, and clients polling at different moments share cache."""
+    frequency = config.ping_config["frequency"]
+    return float(handler.get_argument('stamp')) // frequency * frequency
+
+
+class ResponseCache:
+    """Cache of query results for the current ping window.
+
+    Entries are dropped when a new window begins, `delay` seconds after the ping frequency
+    boundary to let reports of the window arrive. Concurrent misses of the same key share
+    one query."""
+
+    def __init__(self, delay=10, size=10000):
+        self.delay = delay
+        self.size = size
+        self.window = None
+        self.entries = dict()
+        self.pending = dict()
+
+    async def get(self, key, query):
+        window = int((time.time() - self.delay) // config.ping_config["frequency"])
+        if window != self.window:
+            self.window = window
+            self.entries.clear()
+        if key in self.entries:
+            cache_lookups.inc('response', 'hit')
+            return self.entries[key]
+        if (window, key) in self.pending:
+            cache_lookups.inc('response', 'shared')
+            return await asyncio.shield(self.pending[(window, key)])
+        cache_lookups.inc('response', 'miss')
+        future = self.pending[(window, key)] = asyncio.get_running_loop().create_future()
+        try:
+            result = await query()
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved, or asyncio complains if nobody else waited for it.
+            future.exception()
+            raise
+        else:
+            if window == self.window and len(self.entries) < self.size:
+                self.entries[key] = result
+            future.set_result(result)
+            return result
+        finally:
+            del self.pending[(window, key)]
+
+
+class Payload:
+    """Response body kept in response cache, with its ETag and compressed forms.
+
+    Each compressed form is made once, when first asked for."""
+
+    # Bodies smaller than this are not worth compressing.
+    min_compress = 1024
+
+    def __init__(self, body):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+        self.encoded = dict()
+
+    def encoding(self, accept_encoding):
+        """Pick a Content-Encoding accepted by client, or None to send body as is."""
+        if len(self.body) < self.min_compress:
+            return None
+        accepted = set()
+        for i in accept_encoding.split(','):
+            name, _, params = i.partition(';')
+            q = params.replace(' ', '').partition('q=')[2]
+            try:
+                if q and float(q) == 0:
+                    continue
+            except ValueError:
+                continue
+            accepted.add(name.strip().lower())
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def encode(self, encoding):
+        if encoding is None:
+            return self.body
+        if encoding not in self.encoded:
+            if encoding == 'br':
+                self.encoded[encoding] = brotli.compress(self.body)
+            else:
+                self.encoded[encoding] = gzip.compress(self.body)
+        return self.encoded[encoding]
+
+
+def write_payload(handler: tornado.web.RequestHandler, payload: Payload):
+    """Write a cached payload, or answer 304 if client has it already."""
+    handler.set_header('Etag', payload.etag)
+    handler.set_header('Vary', 'Accept, Accept-Encoding')
+    if handler.check_etag_header():
+        handler.set_status(304)
+        return
+    encoding = payload.encoding(handler.request.headers.get('Accept-Encoding', ''))
+    if encoding is not None:
+        handler.set_header('Content-Encoding', encoding)
+    handler.write(payload.encode(encoding))
+
+
+def get_format(handler: tornado.web.RequestHandler):
+    """Get response format of chart series, "json" or "columnar".
+
+    Chosen by `format` argument if given, or else by Accept header."""
+    fmt = handler.get_argument('format', None)
+    if fmt is None:
+        return 'columnar' if columnar.mime in handler.request.headers.get('Accept', '') else 'json'
+    if fmt not in ('json', 'columnar'):
+        raise ValueError("Bad format.")
+    return fmt
+
+
+# Downsampling and columnar encoding of each kind of chart series.
+series_kinds = {
+    'detail': (downsample.detail, columnar.detail),
+    'detail_nodes': (downsample.detail_nodes, columnar.detail_nodes),
+    'glance': (downsample.glance, columnar.glance),
+}
+
+
+async def cached_query(handler: tornado.web.RequestHandler, key, points, kind, query, *args):
+    """Run query through the response cache, downsampling the result to `points` and encoding
+    it in the format asked by the request, as a Payload. Sets Content-Type of the response accordingly."""
+    shape, encode = series_kinds[kind]
+    fmt = get_format(handler)
+
+    async def run():
+        result, err = await query(*args)
+        if err is not None:
+            return None, err
+        if points is not None or fmt == 'columnar':
+            result = None if result is None else json.loads(result)
+            if points is not None and result is not None:
+                result = shape(result, points)
+            result = encode(result) if fmt == 'columnar' else json.dumps(result)
+        return Payload('null' if result is None else result), None
+
+    result, err = await handler.settings['cache'].get(key + (points, fmt), run)
+    if err is None and fmt == 'columnar':
+        handler.set_header('Content-Type', columnar.mime)
+    return result, err
+
+
 class DetailRecordHandler(tornado.web.RequestHandler):
-    @limit_request(3)
+    @limit_request('detail')
     async def get(self):
         if 'node' in self.request.arguments and 'target' in self.request.arguments:
             try:
+                points = get_points(self)
+                node, target = self.get_argument('node'), self.get_argument('target')
                 if 'update' in self.request.arguments and self.request.arguments['update'] == [b'true']:
                     if 'stamp' in self.request.arguments:
-                        result, err = await self.settings['db'].query_ping_from(self.request.arguments['node'],
-                                                                                self.request.arguments['target'],
-                                                                                self.request.arguments['stamp'])
+                        stamp = get_stamp(self)
+                        result, err = await cached_query(self, ('detail', node, target, 'from', stamp),
+                                                         points, 'detail',
+                                                         self.settings['recent'].query_ping_from, node, target, stamp)
                     else:
                         result, err = None, "Missing parameters."
                 else:
-                    result, err = await self.settings['db'].query_ping_hours(
-                            self.request.arguments['node'], self.request.arguments['target'], 24)
+                    result, err = await cached_query(self, ('detail', node, target, 'hours', 24),
+                                                     points, 'detail',
+                                                     self.settings['recent'].query_ping_hours, node, target, 24)
                 if err is not None:
                     self.set_status(400)
                     await self.finish('{"message": "' + err + '"}')
                 else:
-                    self.write(result)
+                    write_payload(self, result)
             except ValueError:
                 self.set_status(400)
                 await self.finish('{"message": "Bad parameter."}')
@@ -93,23 +269,29 @@ class DetailRecordHandler(tornado.web.RequestHandler):
 
 
 class RecordHandler(tornado.web.RequestHandler):
-    @limit_request()
+    @limit_request('record')
     async def get(self):
         if 'target' in self.request.arguments:
             try:
+                points = get_points(self)
+                target = self.get_argument('target')
                 if 'update' in self.request.arguments and self.request.arguments['update'] == [b'true']:
                     if 'stamp' in self.request.arguments:
-                        result, err = await self.settings['db'].query_pingavg_from(self.request.arguments['target'],
-                                                                                   self.request.arguments['stamp'])
+                        stamp = get_stamp(self)
+                        result, err = await cached_query(self, ('record', target, 'from', stamp),
+                                                         points, 'glance',
+                                                         self.settings['recent'].query_pingavg_from, target, stamp)
                     else:
                         result, err = None, "Missing parameters."
                 else:
-                    result, err = await self.settings['db'].query_pingavg_hours(self.request.arguments['target'], 1)
+                    result, err = await cached_query(self, ('record', target, 'hours', 1),
+                                                     points, 'glance',
+                                                     self.settings['recent'].query_pingavg_hours, target, 1)
                 if err is not None:
                     self.set_status(400)
                     await self.finish('{"message": "' + err + '"}')
                 else:
-                    self.write(result)
+                    write_payload(self, result)
             except ValueError:
                 self.set_status(400)
                 await self.finish('{"message": "Bad parameter."}')
@@ -119,7 +301,7 @@ class RecordHandler(tornado.web.RequestHandler):
 
 
 class LongTermRecordHandler(tornado.web.RequestHandler):
-    @limit_request(10)
+    @limit_request('longterm')
     async def get(self):
         if 'target' in self.request.arguments and 'span' in self.request.arguments:
             try:
@@ -128,12 +310,16 @@ class LongTermRecordHandler(tornado.web.RequestHandler):
                     self.set_status(400)
                     await self.finish('{"message": "Too long span."}')
                     return
-                result, err = await self.settings['db'].query_pingavg_hours(self.request.arguments['target'], span)
+                points = get_points(self)
+                target = self.get_argument('target')
+                result, err = await cached_query(self, ('record', target, 'hours', span),
+                                                 points, 'glance',
+                                                 self.settings['recent'].query_pingavg_hours, target, span)
                 if err is not None:
                     self.set_status(400)
                     await self.finish('{"message": "' + err + '"}')
                 else:
-                    self.write(result)
+                    write_payload(self, result)
             except ValueError:
                 self.set_status(400)
                 await self.finish('{"message": "Bad parameter."}')
@@ -143,7 +329,7 @@ class LongTermRecordHandler(tornado.web.RequestHandler):
 
 
 class LongTermDetailRecordHandler(tornado.web.RequestHandler):
-    @limit_request(30)
+    @limit_request('detail_longterm')
     async def get(self):
         if 'node' in self.request.arguments and 'target' in self.request.arguments and 'span' in self.request.arguments:
             try:
@@ -152,13 +338,52 @@ class LongTermDetailRecordHandler(tornado.web.RequestHandler):
                     self.set_status(400)
                     await self.finish('{"message": "Too long span."}')
                     return
-                result, err = await self.settings['db'].query_ping_hours(
-                        self.request.arguments['node'], self.request.arguments['target'], 24 * span)
+                points = get_points(self)
+                node, target = self.get_argument('node'), self.get_argument('target')
+                result, err = await cached_query(self, ('detail', node, target, 'hours', 24 * span),
+                                                 points, 'detail',
+                                                 self.settings['recent'].query_ping_hours, node, target, 24 * span)
+                if err is not None:
+                    self.set_status(400)
+                    await self.finish('{"message": "' + err + '"}')
+                else:
+                    write_payload(self, result)
+            except ValueError:
+                self.set_status(400)
+                await self.finish('{"message": "Bad parameter."}')
+        else:
+            self.set_status(400)
+            await self.finish('{"message": "Missing parameters."}')
+
+
+class BatchDetailRecordHandler(tornado.web.RequestHandler):
+    """Detail records of several nodes of a target, in the form of {node: /api/detailRecord result}.
+
+    Nodes are given as comma separated `nodes`, or are all planets pinging the target if absent.
+    Optional `span` is in days as in /api/detailRecord/longterm, 1 by default."""
+
+    @limit_request('detail_batch')
+    async def get(self):
+        if 'target' in self.request.arguments:
+            try:
+                span = float(self.get_argument('span', '1'))
+                if span > 30:
+                    self.set_status(400)
+                    await self.finish('{"message": "Too long span."}')
+                    return
+                points = get_points(self)
+                target = self.get_argument('target')
+                nodes = self.get_argument('nodes', None)
+                nodes = None if nodes is None else tuple(sorted(set(nodes.split(','))))
+                result, err = await cached_query(self, ('detail_nodes', nodes, target, 'hours', 24 * span),
+                                                 points, 'detail_nodes',
+                                                 self.settings['recent'].query_ping_nodes_hours,
+                                                 nodes, target, 24 * span)
                 if err is not None:
                     self.set_status(400)
                     await self.finish('{"message": "' + err + '"}')
                 else:
-                    self.write(result)
+                    write_payload(self, result)
             except ValueError:
                 self.set_status(400)
                 await self.finish('{"message": "Bad parameter."}')
@@ -167,8 +392,452 @@ class LongTermDetailRecordHandler(tornado.web.RequestHandler):
             await self.finish('{"message": "Missing parameters."}')
 
 
+class LiveHub:
+    """Fan out new ping records announced by database to live clients.
+
+    Clients subscribe to a target, receiving records in the form of /api/record updates,
+    or to a (target, node) pair, receiving records in the form of /api/detailRecord updates.
+    Subscribers who may have missed records are sent `resync` instead, to catch up by polling."""
+
+    resync = object()
+
+    def __init__(self, db):
+        self.db = db
+        self.subscribers = dict()
+
+    def subscribe(self, key, queue: asyncio.Queue):
+        self.subscribers.setdefault(key, set()).add(queue)
+
+    def unsubscribe(self, key, queue: asyncio.Queue):
+        self.subscribers[key].discard(queue)
+        if not self.subscribers[key]:
+            del self.subscribers[key]
+
+    def publish(self, payload):
+        if payload is None:
+            # Announcements were missed while reconnecting.
+            for key in self.subscribers:
+                self.deliver(key, self.resync)
+            return
+        p = json.loads(payload)
+        if p['node'] not in self.db.nodes:
+            return
+        if (p['name'], None) in self.subscribers and self.db.nodes[p['node']][1] == 'planet':
+            self.deliver((p['name'], None), json.dumps([{
+                "name": p['node'],
+                "shown_name": self.db.nodes[p['node']][2],
+                "data": [{"stamp": p['stamp'], "timeout": p['timeout'], "avg": p['avg']}]
+            }]))
+        if (p['name'], p['node']) in self.subscribers:
+            self.deliver((p['name'], p['node']), json.dumps({
+                i: [p['stamp'] if i == 'time' else p[i]]
+                for i in ('time', 'timeout', 'avg', 'min', 'max', 'std_dev', 'drop', 'total')}))
+
+    def deliver(self, key, data):
+        for queue in self.subscribers[key]:
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # Client too slow to keep up. Drop what is queued and have it catch up by polling.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.resync)
+
+
+class LatestTable:
+    """Latest ping record of every (node, target), kept up to date from records announced by database.
+
+    Seeded with one query at start, and again whenever announcements may have been missed."""
+
+    # Records older than this are not seeded, leaving their node shown as down.
+    window = 3600
+
+    def __init__(self, db):
+        self.db = db
+        self.latest = dict()
+        # Bumped on every change, to tell whether a memoized matrix is current.
+        self.version = 0
+        self.matrices = dict()
+
+    async def seed(self):
+        for i in await self.db.query_ping_latest(time.time() - self.window):
+            self.update(i['node'], i['name'], i['stamp'], i['timeout'], i['avg'], i['drop'], i['total'])
+
+    def update(self, node, target, stamp, timeout, avg, drop, total):
+        current = self.latest.get((node, target))
+        if current is None or current[0] < stamp:
+            self.latest[(node, target)] = (stamp, timeout, avg, drop, total)
+            self.version += 1
+
+    def publish(self, payload):
+        if payload is None:
+            asyncio.ensure_future(self.seed())
+            return
+        p = json.loads(payload)
+        self.update(p['node'], p['name'], p['stamp'], p['timeout'], p['avg'], p['drop'], p['total'])
+
+    def matrix(self, group):
+        """Latest records of targets of group, as a Payload of /api/groupMatrix."""
+        version = (self.version, self.db.cache_version)
+        memo = self.matrices.get(group)
+        if memo is not None and memo[0] == version:
+            return memo[1]
+        targets = self.db.group_info[group]
+        planets = set()
+        for target in targets:
+            planets.update(self.db.target_planets(target))
+        nodes = [name for name in self.db.nodes if name in planets]
+        result = {
+            "nodes": [{"name": i, "shown_name": self.db.nodes[i][2]} for i in nodes],
+            "targets": [{"name": i, "shown_name": self.db.ping_targets[i][0]} for i in targets],
+            "stamp": [], "timeout": [], "avg": [], "loss": [],
+        }
+        for target in targets:
+            row = [self.latest.get((node, target)) for node in nodes]
+            result["stamp"].append([None if i is None else i[0] for i in row])
+            result["timeout"].append([None if i is None else i[1] for i in row])
+            result["avg"].append([None if i is None else i[2] for i in row])
+            # drop and total may be null, as for records of a node that could not ping at all.
+            result["loss"].append([i[3] / i[4] if i is not None and i[3] is not None and i[4] else None
+                                   for i in row])
+        payload = Payload(json.dumps(result))
+        self.matrices[group] = version, payload
+        return payload
+
+
+class RingSeries:
+    """Ping records of a (node, target) in a ring of fixed capacity, one typed array per column.
+
+    Null values are kept as NaN in float columns and -1 in integer ones."""
+
+    columns = (('time', 'd'), ('timeout', 'b'), ('avg', 'f'), ('min', 'f'), ('max', 'f'), ('std_dev', 'f'),
+               ('drop', 'h'), ('total', 'h'))
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.start = 0
+        self.count = 0
+        self.data = {name: array.array(code, bytes(array.array(code).itemsize * capacity))
+                     for name, code in self.columns}
+
+    def nbytes(self):
+        return sum(i.itemsize * len(i) for i in self.data.values())
+
+    def last(self):
+        return None if not self.count else self.data['time'][(self.start + self.count - 1) % self.capacity]
+
+    def append(self, record):
+        i = (self.start + self.count) % self.capacity
+        for name, code in self.columns:
+            value = record[name]
+            if value is None:
+                value = math.nan if code in 'fd' else -1
+            self.data[name][i] = value
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def find(self, stamp):
+        """Position of the first record after stamp."""
+        times, lo, hi = self.data['time'], 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(self.start + mid) % self.capacity] <= stamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def select(self, start, end, names):
+        """Columns of records in (start, end], or None if there is none."""
+        lo, hi = self.find(start), self.find(end)
+        if lo == hi:
+            return None
+        indexes = [(self.start + i) % self.capacity for i in range(lo, hi)]
+        result = dict()
+        for name, code in self.columns:
+            if name not in names:
+                continue
+            column = self.data[name]
+            if code == 'b':
+                result[name] = [bool(column[i]) for i in indexes]
+            elif code == 'h':
+                result[name] = [None if column[i] < 0 else column[i] for i in indexes]
+            elif code == 'f':
+                # Shortest text of float32 values, as database gives.
+                result[name] = [None if column[i] != column[i] else float(f'{column[i]:.7g}') for i in indexes]
+            else:
+                result[name] = [column[i] for i in indexes]
+        return result
+
+
+hot_window_bytes = metrics.Gauge('starping_hot_window_bytes', 'Memory held by ping records of the hot window.')
+hot_window_series = metrics.Gauge('starping_hot_window_series', 'Series of (node, target) held by the hot window.')
+
+
+class HotWindow:
+    """Recent ping records held in memory, answering chart queries within the window without database.
+
+    Records of a target are loaded with one query when first asked for, and kept up to date from
+    records announced by database. At most `targets` targets are held, the least recently asked
+    for dropped first. Queries reaching beyond the window, or needing rollups, go to database.
+    Methods answer as the Database methods of the same name."""
+
+    detail_columns = ('time', 'timeout', 'avg', 'min', 'max', 'std_dev', 'drop', 'total')
+
+    def __init__(self, db, hours=24, targets=100):
+        self.db = db
+        self.frequency = config.ping_config["frequency"]
+        # Spans longer than this are shown from rollups.
+        self.window = min(hours * 3600, self.frequency * config.rollup_config["max_points"])
+        self.capacity = int(self.window // self.frequency) + 60
+        self.targets = targets
+        # target -> {node: RingSeries}, least recently used first.
+        self.series = collections.OrderedDict()
+        # target -> (future of load, records announced while loading)
+        self.loading = dict()
+        # Targets loading when announcements may have been missed.
+        self.missed = set()
+        metrics.before_collect(self._collect)
+
+    def _collect(self):
+        hot_window_series.set(sum(len(i) for i in self.series.values()))
+        hot_window_bytes.set(sum(j.nbytes() for i in self.series.values() for j in i.values()))
+
+    def covers(self, start, end):
+        """Whether records in (start, end] are held, end being now."""
+        return start >= end - self.window and database.ping_resolution(start, end) == self.frequency
+
+    def publish(self, payload):
+        if payload is None:
+            # Records may be missed. Load them again when asked for.
+            self.series.clear()
+            self.missed.update(self.loading)
+            return
+        p = json.loads(payload)
+        p['time'] = p['stamp']
+        if p['name'] in self.loading:
+            self.loading[p['name']][1].append(p)
+        elif p['name'] in self.series:
+            self.add(p['name'], p)
+
+    def add(self, target, record):
+        series = self.series[target].get(record['node'])
+        if series is None:
+            series = self.series[target][record['node']] = RingSeries(self.capacity)
+        last = series.last()
+        if last is not None and record['time'] <= last:
+            if record['time'] < last:
+                # Late record. Load target again rather than insert it.
+                del self.series[target]
+            return
+        series.append(record)
+
+    async def load(self, target):
+        """Series of planets of target, loading them first if not held, or None if they can't be held now."""
+        if target in self.series:
+            self.series.move_to_end(target)
+            return self.series[target]
+        if target in self.loading:
+            await self.loading[target][0]
+            return self.series.get(target)
+        future = asyncio.get_event_loop().create_future()
+        self.loading[target] = future, []
+        try:
+            result, err = await self.db.query_ping_nodes_hours(None, target, self.window / 3600)
+            if err is not None:
+                raise RuntimeError(f'Failed loading records of {target}: {err}')
+            if target in self.missed:
+                # Records announced meanwhile may be missed. Load again on next query.
+                return None
+            pending = self.loading[target][1]
+            loaded = dict()
+            for node, data in json.loads(result).items():
+                series = loaded[node] = RingSeries(self.capacity)
+                for i in range(len(data['time'])):
+                    series.append({name: data[name][i] for name in self.detail_columns})
+            self.series[target] = loaded
+            for record in pending:
+                if target in self.series:
+                    self.add(target, record)
+            while len(self.series) > self.targets:
+                self.series.popitem(last=False)
+        finally:
+            del self.loading[target]
+            self.missed.discard(target)
+            future.set_result(None)
+        return self.series.get(target)
+
+    async def detail(self, planets, target, start, end):
+        """Detail series of planets, or None if not held."""
+        series = await self.load(target)
+        if series is None:
+            return None
+        result = dict()
+        for planet in planets:
+            data = None if planet not in series else series[planet].select(start, end, self.detail_columns)
+            if data is not None:
+                data['step'] = self.frequency
+                result[planet] = data
+        return result
+
+    @database.unpack
+    async def query_ping_hours(self, planet, target, hours):
+        now = time.time()
+        if hours <= 0 or not self.covers(now - 3600 * hours, now):
+            return await self.db.query_ping_hours(planet, target, hours)
+        return await self._query_ping_timespan(planet, target, now - 3600 * hours, now)
+
+    @database.unpack
+    async def query_ping_from(self, planet, target, stamp):
+        now = time.time()
+        stamp = float(stamp)
+        if stamp <= 0 or stamp > now or not self.covers(stamp, now):
+            return await self.db.query_ping_from(planet, target, stamp)
+        return await self._query_ping_timespan(planet, target, stamp, now)
+
+    async def _query_ping_timespan(self, planet, target, start, end):
+        err = self.db.check_planet(planet) or self.db.check_pingtarget(target)
+        if err is not None:
+            return None, err
+        result = await self.detail([planet], target, start, end)
+        if result is None:
+            return await self.db.query_ping_timespan(planet, target, start, end)
+        data = result.get(planet)
+        if data is None:
+            data = {i: None for i in self.detail_columns}
+            data['step'] = self.frequency
+        return json.dumps(data), None
+
+    async def query_ping_nodes_hours(self, planets, target, hours):
+        now = time.time()
+        if hours <= 0 or not self.covers(now - 3600 * hours, now):
+            return await self.db.query_ping_nodes_hours(planets, target, hours)
+        err = self.db.check_pingtarget(target)
+        if err is not None:
+            return None, err
+        if planets is None:
+            planets = self.db.target_planets(target)
+        for planet in planets:
+            err = self.db.check_planet(planet)
+            if err is not None:
+                return None, err
+        result = await self.detail(planets, target, now - 3600 * hours, now)
+        if result is None:
+            return await self.db.query_ping_nodes_hours(planets, target, hours)
+        return json.dumps(result), None
+
+    @database.unpack
+    async def query_pingavg_hours(self, target, hours):
+        now = time.time()
+        if hours <= 0 or not self.covers(now - 3600 * hours, now):
+            return await self.db.query_pingavg_hours(target, hours)
+        return await self._query_pingavg_timespan(target, now - 3600 * hours, now)
+
+    @database.unpack
+    async def query_pingavg_from(self, target, stamp):
+        now = time.time()
+        stamp = float(stamp)
+        if stamp <= 0 or stamp > now or not self.covers(stamp, now):
+            return await self.db.query_pingavg_from(target, stamp)
+        return await self._query_pingavg_timespan(target, stamp, now)
+
+    async def _query_pingavg_timespan(self, target, start, end):
+        err = self.db.check_pingtarget(target)
+        if err is not None:
+            return None, err
+        series = await self.load(target)
+        if series is None:
+            return await self.db.query_pingavg_timespan(target, start, end)
+        result = []
+        for name, (_, typ, shown_name) in self.db.nodes.items():
+            if typ != 'planet':
+                continue
+            data = None if name not in series else series[name].select(start, end, ('time', 'timeout', 'avg'))
+            if data is not None:
+                data = [{"stamp": i, "timeout": j, "avg": k} for i, j, k in zip(data['time'], data['timeout'],
+                                                                               data['avg'])]
+            result.append({"name": name, "shown_name": shown_name, "data": data})
+        return json.dumps(result), None
+
+
+class GroupMatrixHandler(tornado.web.RequestHandler):
+    """Latest record of every node and target of a group.
+
+    stamp, timeout, avg and loss are lists of rows, one per target, of a value per node, in the
+    order of "targets" and "nodes". Values are null where the node has no recent record of the target."""
+
+    @limit_request('matrix')
+    async def get(self):
+        if 'group' in self.request.arguments:
+            group = self.get_argument('group')
+            if group not in self.settings['db'].group_info:
+                self.set_status(400)
+                await self.finish('{"message": "Non-exist group."}')
+                return
+            write_payload(self, self.settings['latest'].matrix(group))
+        else:
+            self.set_status(400)
+            await self.finish('{"message": "Missing parameters."}')
+
+
+class LiveHandler(tornado.web.RequestHandler):
+    """Stream new ping records of a target, or a target from a node, as Server-Sent Events."""
+
+    queue = None
+
+    @limit_request('live')
+    async def get(self):
+        if 'target' not in self.request.arguments:
+            self.set_status(400)
+            await self.finish('{"message": "Missing parameters."}')
+            return
+        target, node = self.get_argument('target'), self.get_argument('node', None)
+        err = self.settings['db'].check_pingtarget(target)
+        if err is None and node is not None:
+            err = self.settings['db'].check_planet(node)
+        if err is not None:
+            self.set_status(400)
+            await self.finish('{"message": "' + err + '"}')
+            return
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.queue = asyncio.Queue(maxsize=100)
+        self.settings['live'].subscribe((target, node), self.queue)
+        try:
+            self.write(f'retry: {config.ping_config["frequency"] * 1000}\n\n')
+            await self.flush()
+            while True:
+                try:
+                    data = await asyncio.wait_for(self.queue.get(), 30)
+                except asyncio.TimeoutError:
+                    # Keep idle connection from being cut by proxies.
+                    self.write(': keep-alive\n\n')
+                else:
+                    if data is None:
+                        break
+                    if data is LiveHub.resync:
+                        self.write('event: resync\ndata: \n\n')
+                    else:
+                        self.write(f'data: {data}\n\n')
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.settings['live'].unsubscribe((target, node), self.queue)
+
+    def on_connection_close(self):
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+                self.queue.put_nowait(None)
+
+
 class RouteHandler(tornado.web.RequestHandler):
-    @limit_request()
+    @limit_request('route')
     async def get(self):
         if 'target' in self.request.arguments and 'node' in self.request.arguments and 'time' in self.request.arguments:
             try:
@@ -191,23 +860,181 @@ class RouteHandler(tornado.web.RequestHandler):
             await self.finish('{"message": "Missing parameters."}')
 
 
+def get_timespan(handler: tornado.web.RequestHandler):
+    """Get `start` and optional `end` arguments, end being now if absent."""
+    return float(handler.get_argument('start')), float(handler.get_argument('end', str(time.time())))
+
+
+class RouteChangesHandler(tornado.web.RequestHandler):
+    """Times the route from node to target changed in (start, end], as [{"time", "fingerprint"}].
+
+    The first record of the span is always included, giving the route at the start."""
+
+    @limit_request('route_range')
+    async def get(self):
+        if 'target' in self.request.arguments and 'node' in self.request.arguments and \
+                'start' in self.request.arguments:
+            try:
+                start, end = get_timespan(self)
+                if end - start > 30 * 24 * 60 * 60:
+                    self.set_status(400)
+                    await self.finish('{"message": "Too long span."}')
+                    return
+                result, err = await self.settings['db'].query_mtr_changes(self.get_argument('node'),
+                                                                          self.get_argument('target'), start, end)
+                if err is not None:
+                    self.set_status(400)
+                    await self.finish('{"message": "' + err + '"}')
+                else:
+                    write_payload(self, Payload(result))
+            except ValueError:
+                self.set_status(400)
+                await self.finish('{"message": "Bad parameter."}')
+        else:
+            self.set_status(400)
+            await self.finish('{"message": "Missing parameters."}')
+
+
+class RouteRangeHandler(tornado.web.RequestHandler):
+    """Mtr records from node to target in (start, end], as [{"time", "fingerprint", "data"}], data
+    being as in /api/route. With `changes=true`, only records where the route changed.
+    At most `max_records` records are given, the latest ones."""
+
+    max_records = 100
+
+    @limit_request('route_range')
+    async def get(self):
+        if 'target' in self.request.arguments and 'node' in self.request.arguments and \
+                'start' in self.request.arguments:
+            try:
+                start, end = get_timespan(self)
+                if end - start > 30 * 24 * 60 * 60:
+                    self.set_status(400)
+                    await self.finish('{"message": "Too long span."}')
+                    return
+                changes = self.get_argument('changes', 'false') == 'true'
+                result, err = await self.settings['db'].query_mtr_range(self.get_argument('node'),
+                                                                        self.get_argument('target'), start, end,
+                                                                        changes, self.max_records)
+                if err is not None:
+                    self.set_status(400)
+                    await self.finish('{"message": "' + err + '"}')
+                else:
+                    write_payload(self, Payload(result))
+            except ValueError:
+                self.set_status(400)
+                await self.finish('{"message": "Bad parameter."}')
+        else:
+            self.set_status(400)
+            await self.finish('{"message": "Missing parameters."}')
+
+
+class RouteHopHandler(tornado.web.RequestHandler):
+    """Latency at hop `hop` of the route from node to target in (start, end], in the form of /api/detailRecord."""
+
+    @limit_request('route_range')
+    async def get(self):
+        if 'target' in self.request.arguments and 'node' in self.request.arguments and \
+                'hop' in self.request.arguments and 'start' in self.request.arguments:
+            try:
+                start, end = get_timespan(self)
+                if end - start > 30 * 24 * 60 * 60:
+                    self.set_status(400)
+                    await self.finish('{"message": "Too long span."}')
+                    return
+                result, err = await self.settings['db'].query_mtr_hop(self.get_argument('node'),
+                                                                      self.get_argument('target'),
+                                                                      int(self.get_argument('hop')), start, end)
+                if err is not None:
+                    self.set_status(400)
+                    await self.finish('{"message": "' + err + '"}')
+                else:
+                    write_payload(self, Payload(result))
+            except ValueError:
+                self.set_status(400)
+                await self.finish('{"message": "Bad parameter."}')
+        else:
+            self.set_status(400)
+            await self.finish('{"message": "Missing parameters."}')
+
+
+class RouteThroughHandler(tornado.web.RequestHandler):
+    """Nodes and targets whose route went through address `ip` in the last `hours` hours, 24 by default,
+    as [{"node", "target"}]. Any address answering at a hop counts, not only the first one."""
+
+    @limit_request('route_range')
+    async def get(self):
+        if 'ip' in self.request.arguments:
+            try:
+                hours = float(self.get_argument('hours', '24'))
+                if hours > 7 * 24:
+                    self.set_status(400)
+                    await self.finish('{"message": "Too long span."}')
+                    return
+                result, err = await self.settings['db'].query_mtr_through(self.get_argument('ip'),
+                                                                          time.time() - hours * 60 * 60)
+                if err is not None:
+                    self.set_status(400)
+                    await self.finish('{"message": "' + err + '"}')
+                else:
+                    write_payload(self, Payload(result))
+            except ValueError:
+                self.set_status(400)
+                await self.finish('{"message": "Bad parameter."}')
+        else:
+            self.set_status(400)
+            await self.finish('{"message": "Missing parameters."}')
+
+
 # WebPages
 
-class MainPageHandler(tornado.web.RequestHandler):
+class PageCache:
+    """Rendered pages, kept until nodes, targets or groups cached by database are reloaded."""
+
+    def __init__(self, db):
+        self.db = db
+        self.version = None
+        self.pages = dict()
+
+    def get(self, key, render):
+        if self.version != self.db.cache_version:
+            self.version = self.db.cache_version
+            self.pages.clear()
+        if key not in self.pages:
+            cache_lookups.inc('page', 'miss')
+            self.pages[key] = render()
+        else:
+            cache_lookups.inc('page', 'hit')
+        return self.pages[key]
+
+
+class PageHandler(tornado.web.RequestHandler):
+    def render_page(self, key, template, **kwargs):
+        """Render template, reusing the page rendered for key unless templates are reloaded on change."""
+        def render():
+            return self.settings['template'].load(template).generate(static_url=self.static_url, **kwargs)
+
+        if not self.settings.get('compiled_template_cache', True):
+            self.settings['template'].reset()
+            return render()
+        return self.settings['pages'].get(key, render)
+
+
+class MainPageHandler(PageHandler):
     async def get(self):
-        await self.finish(self.settings['template'].load('main.html').generate(
-                groups=self.settings['db'].groups,
-                group_names=self.settings['db'].group_names
-        ))
+        await self.finish(self.render_page(('main',), 'main.html',
+                                           groups=self.settings['db'].groups,
+                                           group_names=self.settings['db'].group_names))
 
 
-class GroupPageHandler(tornado.web.RequestHandler):
+class GroupPageHandler(PageHandler):
     async def get(self, group_name):
         if group_name not in self.settings['db'].group_names:
             self.set_status(404)
             await self.finish()
             return
-        await self.finish(self.settings['template'].load('group.html').generate(
+        await self.finish(self.render_page(
+                ('group', group_name), 'group.html',
                 groups=self.settings['db'].groups,
                 group_name=group_name,
                 group_names=self.settings['db'].group_names,
@@ -217,7 +1044,7 @@ class GroupPageHandler(tornado.web.RequestHandler):
         ))
 
 
-class TargetPageHandler(tornado.web.RequestHandler):
+class TargetPageHandler(PageHandler):
     async def get(self, group_name, target_name):
         if group_name not in self.settings['db'].group_names:
             self.set_status(404)
@@ -232,7 +1059,8 @@ class TargetPageHandler(tornado.web.RequestHandler):
             nodelist = self.settings['db'].nodes.keys()
         else:
             nodelist = nodes
-        await self.finish(self.settings['template'].load('target.html').generate(
+        await self.finish(self.render_page(
+                ('target', group_name, target_name), 'target.html',
                 groups=self.settings['db'].groups,
                 group_name=group_name,
                 target_name=target_name,
@@ -244,7 +1072,7 @@ class TargetPageHandler(tornado.web.RequestHandler):
         ))
 
 
-class RoutePageHandler(tornado.web.RequestHandler):
+class RoutePageHandler(PageHandler):
     async def get(self, group_name, target_name, node_name):
         if group_name not in self.settings['db'].group_names:
             self.set_status(404)
@@ -258,7 +1086,8 @@ class RoutePageHandler(tornado.web.RequestHandler):
             self.set_status(404)
             await self.finish()
             return
-        await self.finish(self.settings['template'].load('route.html').generate(
+        await self.finish(self.render_page(
+                ('route', group_name, target_name, node_name), 'route.html',
                 groups=self.settings['db'].groups,
                 group_name=group_name,
                 target_name=target_name,
@@ -270,34 +1099,65 @@ class RoutePageHandler(tornado.web.RequestHandler):
         ))
 
 
-class AboutPageHandler(tornado.web.RequestHandler):
+class AboutPageHandler(PageHandler):
     async def get(self):
-        await self.finish(self.settings['template'].load('about.html').generate(
-                groups=self.settings['db'].groups,
-                group_names=self.settings['db'].group_names
-        ))
+        await self.finish(self.render_page(('about',), 'about.html',
+                                           groups=self.settings['db'].groups,
+                                           group_names=self.settings['db'].group_names))
 
 
 application = tornado.web.Application([
     (r'/api/detailRecord/longterm', LongTermDetailRecordHandler),
+    (r'/api/detailRecord/batch', BatchDetailRecordHandler),
     (r'/api/detailRecord', DetailRecordHandler),
     (r'/api/record/longterm', LongTermRecordHandler),
     (r'/api/record', RecordHandler),
+    (r'/api/route/changes', RouteChangesHandler),
+    (r'/api/route/range', RouteRangeHandler),
+    (r'/api/route/hop', RouteHopHandler),
+    (r'/api/route/through', RouteThroughHandler),
     (r'/api/route', RouteHandler),
-    (r'/files/(.*)', tornado.web.StaticFileHandler, {"path": "./static/files"}),
+    (r'/api/live', LiveHandler),
+    (r'/api/groupMatrix', GroupMatrixHandler),
+    (r'/metrics', metrics.MetricsHandler),
+    (r'/admin/slow', metrics.SlowCallsHandler),
     (r'/', MainPageHandler),
     (r'/about', AboutPageHandler),
     (r'/group/(.*)', GroupPageHandler),
     (r'/target/(.*)/(.*)', TargetPageHandler),
     (r'/route/(.*)/(.*)/(.*)', RoutePageHandler)
-], debug=True, autoreload=True, compiled_template_cache=False, static_hash_cache=False)
+], static_path="./static/files", static_url_prefix="/files/", log_function=metrics.log_request,
+    debug=config.server_config["debug"] and config.server_config["web_workers"] == 1)
 
 if __name__ == "__main__":
+    # Workers are forked before any event loop or connection is made, and share the listening socket.
+    sockets = tornado.netutil.bind_sockets(4081)
+    if config.server_config["web_workers"] != 1:
+        tornado.process.fork_processes(config.server_config["web_workers"])
     if platform.system() == "Windows":
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     event_loop = asyncio.get_event_loop()
-    application.settings['db'] = event_loop.run_until_complete(database.get_db())
+    application.settings['db'] = event_loop.run_until_complete(
+        database.get_db(database.pool_size(config.server_config["web_workers"])))
     application.settings['template'] = tornado.template.Loader("./static")
+    application.settings['pages'] = PageCache(application.settings['db'])
+    application.settings['cache'] = ResponseCache(**config.cache_config)
+    application.settings['live'] = LiveHub(application.settings['db'])
+    event_loop.run_until_complete(application.settings['db'].listen('starping_ping',
+                                                                     application.settings['live'].publish))
+    if config.hot_window_config["enabled"]:
+        application.settings['recent'] = HotWindow(application.settings['db'], config.hot_window_config["hours"],
+                                                   config.hot_window_config["targets"])
+        event_loop.run_until_complete(application.settings['db'].listen('starping_ping',
+                                                                         application.settings['recent'].publish))
+    else:
+        application.settings['recent'] = application.settings['db']
+    application.settings['latest'] = LatestTable(application.settings['db'])
+    event_loop.run_until_complete(application.settings['latest'].seed())
+    event_loop.run_until_complete(application.settings['db'].listen('starping_ping',
+                                                                     application.settings['latest'].publish))
+    if config.rate_limit_backend == 'database' and not tornado.process.task_id():
+        tornado.ioloop.PeriodicCallback(application.settings['db'].expire_rate_limits, 60 * 1000).start()
     server = tornado.httpserver.HTTPServer(application, xheaders=True)
-    server.listen(4081)
+    server.add_sockets(sockets)
     tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,155 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Metrics of a process, served in Prometheus text format by MetricsHandler.
+# Each process keeps its own, so with several workers a scrape sees the worker it reaches.
+
+import json
+import math
+
+import tornado.web
+from tornado.log import access_log
+
+registry = []
+collectors = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels_text(names, values, extra=()):
+    pairs = [f'{i}="{escape(j)}"' for i, j in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def number(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = dict()
+        registry.append(self)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} {self.type}'
+        for values, value in self.values.items():
+            yield f'{self.name}{labels_text(self.labels, values)} {number(value)}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, labels=(), buckets=default_buckets):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            # Count of each bucket, then sum of values.
+            counts = self.values[labels] = [0] * len(self.buckets) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-1] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} {self.type}'
+        for values, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield f'{self.name}_bucket{labels_text(self.labels, values, (("le", number(bound)),))} {total}'
+            yield f'{self.name}_sum{labels_text(self.labels, values)} {number(counts[-1])}'
+            yield f'{self.name}_count{labels_text(self.labels, values)} {total}'
+
+
+def before_collect(callback):
+    """Have callback() called before each scrape, to update gauges read from elsewhere."""
+    collectors.append(callback)
+
+
+def render():
+    for callback in collectors:
+        callback()
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+request_duration = Histogram('starping_request_duration_seconds', 'Time serving requests, by handler.',
+                             ('handler', 'method'))
+requests = Counter('starping_requests_total', 'Requests served, by handler and status.', ('handler', 'status'))
+
+
+def log_request(handler: tornado.web.RequestHandler):
+    """Application log_function recording request metrics, then logging as tornado does by default."""
+    name = type(handler).__name__
+    duration = handler.request.request_time()
+    request_duration.observe(duration, name, handler.request.method)
+    requests.inc(name, handler.get_status())
+    if handler.get_status() < 400:
+        log_method = access_log.info
+    elif handler.get_status() < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method("%d %s %.2fms", handler.get_status(), handler._request_summary(), 1000.0 * duration)
+
+
+class LocalHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        if self.request.remote_ip != '127.0.0.1' and self.request.remote_ip != '::1':
+            raise tornado.web.HTTPError(403)
+
+
+class MetricsHandler(LocalHandler):
+    async def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        await self.finish(render())
+
+
+class SlowCallsHandler(LocalHandler):
+    """Recent slow database calls, newest first. See `config.trace_config`."""
+
+    async def get(self):
+        self.set_header('Content-Type', 'application/json')
+        await self.finish(json.dumps(list(reversed(self.settings['db'].tracer.slow_calls))))
@@ -0,0 +1,21 @@
+-- Adds StarPing_PingRollup to databases created before it was in initsql.sql.
+-- Existing records are aggregated by report.py when it starts.
+
+-- Ping records aggregated into buckets of `resolution` seconds, serving charts over long spans.
+-- count is number of records in the bucket and timeout_count number of them timed out.
+-- avg, min, max and std_dev are over records not timed out, drop and total are summed.
+CREATE TABLE StarPing_PingRollup (
+    resolution integer NOT NULL,
+    node text REFERENCES StarPing_Nodes(name) ON DELETE CASCADE,
+    name text REFERENCES StarPing_PingTargets(name) ON DELETE CASCADE,
+    time timestamptz NOT NULL, -- start of bucket
+    count smallint NOT NULL,
+    timeout_count smallint NOT NULL,
+    avg real,
+    min real,
+    max real,
+    std_dev real,
+    drop integer,
+    total integer,
+    PRIMARY KEY (resolution, node, name, time)
+);
@@ -0,0 +1,24 @@
+-- Moves records of databases created before they were partitioned by time to the new layout.
+-- Each node's partition becomes partitioned by month. Existing records are kept in one
+-- partition covering everything before the current month, named after the previous month,
+-- so it is dropped as a whole once that month is out of retention.
+-- Partitions of current and following months are created by report.py when it starts.
+
+DO $$
+DECLARE
+    node text;
+    tbl text;
+    bound text := to_char(date_trunc('month', now() AT TIME ZONE 'UTC'), 'YYYY-MM-DD') || ' 00:00:00+00';
+    legacy text := to_char(date_trunc('month', now() AT TIME ZONE 'UTC') - interval '1 month', 'YYYYMM');
+BEGIN
+    FOR node IN SELECT name FROM StarPing_Nodes LOOP
+        FOREACH tbl IN ARRAY ARRAY['StarPing_PingData', 'StarPing_MTRData'] LOOP
+            EXECUTE format('ALTER TABLE %1$s DETACH PARTITION %1$s_%2$s', tbl, node);
+            EXECUTE format('ALTER TABLE %1$s_%2$s RENAME TO %1$s_%2$s_%3$s', tbl, node, legacy);
+            EXECUTE format('CREATE TABLE %1$s_%2$s PARTITION OF %1$s FOR VALUES IN (%3$L) PARTITION BY RANGE (time)',
+                           tbl, node, node);
+            EXECUTE format('ALTER TABLE %1$s_%2$s ATTACH PARTITION %1$s_%2$s_%3$s FOR VALUES FROM (MINVALUE) TO (%4$L)',
+                           tbl, node, legacy, bound);
+        END LOOP;
+    END LOOP;
+END $$;
@@ -0,0 +1,15 @@
+-- Adds ping record notification to databases created before it was in initsql.sql.
+
+-- Announce every new ping record on channel starping_ping, for live chart updates.
+CREATE FUNCTION starping_notify_ping() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('starping_ping', json_build_object(
+        'node', NEW.node, 'name', NEW.name, 'stamp', extract(epoch from NEW.time), 'timeout', NEW.timeout,
+        'avg', NEW.avg, 'min', NEW.min, 'max', NEW.max, 'std_dev', NEW.std_dev, 'drop', NEW.drop, 'total', NEW.total
+    )::text);
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER StarPing_PingData_Notify AFTER INSERT ON StarPing_PingData
+    FOR EACH ROW EXECUTE FUNCTION starping_notify_ping();
@@ -0,0 +1,12 @@
+-- Adds shared rate limit buckets to databases created before they were in initsql.sql.
+
+-- Token buckets of request rate limits, when shared by all processes. See config.rate_limit_backend.
+-- A bucket is full again at full_at and can be forgotten after that.
+CREATE UNLOGGED TABLE StarPing_RateLimit (
+    endpoint text NOT NULL,
+    key text NOT NULL,
+    tokens real NOT NULL,
+    stamp timestamptz NOT NULL,
+    full_at timestamptz NOT NULL,
+    PRIMARY KEY (endpoint, key)
+);
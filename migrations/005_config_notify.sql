@@ -0,0 +1,21 @@
+-- Adds cache invalidation notification to databases created before it was in initsql.sql.
+
+-- Announce changes of nodes, targets and groups on channel starping_config, with the name of table
+-- changed, so every process rebuilds its cache of that table. See Database.invalidate_cache.
+CREATE FUNCTION starping_notify_config() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('starping_config', TG_TABLE_NAME);
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER StarPing_Nodes_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_Nodes
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+CREATE TRIGGER StarPing_PingTargets_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_PingTargets
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+CREATE TRIGGER StarPing_MTRTargets_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_MTRTargets
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+CREATE TRIGGER StarPing_L1TargetGroup_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_L1TargetGroup
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
+CREATE TRIGGER StarPing_L2TargetGroup_Notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON StarPing_L2TargetGroup
+    FOR EACH STATEMENT EXECUTE FUNCTION starping_notify_config();
@@ -0,0 +1,20 @@
+-- Adds route fingerprints of mtr records to databases created before they were in initsql.sql.
+
+ALTER TABLE StarPing_MTRData ADD COLUMN fingerprint bigint;
+
+-- Same as database.route_fingerprint, for records stored before.
+CREATE FUNCTION starping_route_fingerprint(data jsonb) RETURNS bigint LANGUAGE sql IMMUTABLE AS $$
+    SELECT ('x' || substr(md5(coalesce(string_agg(
+        CASE WHEN (hop->>'timeout')::bool THEN '*' ELSE coalesce((
+            SELECT string_agg(addr->>'ip', '|' ORDER BY addr->>'ip' COLLATE "C")
+            FROM jsonb_array_elements(hop->'addr') addr
+        ), '') END, ',' ORDER BY (hop->>'index')::integer), '')), 1, 16))::bit(64)::bigint
+    FROM jsonb_array_elements(data) hop;
+$$;
+
+UPDATE StarPing_MTRData SET fingerprint = starping_route_fingerprint(data) WHERE data IS NOT NULL;
+
+DROP FUNCTION starping_route_fingerprint(jsonb);
+
+-- Route changes of a node and target are found from this index alone.
+CREATE INDEX StarPing_MTRData_Route_Index ON StarPing_MTRData(node, name, time) INCLUDE (fingerprint);
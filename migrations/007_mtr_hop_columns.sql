@@ -0,0 +1,51 @@
+-- Moves hops of mtr records from jsonb data to typed arrays, for databases created before they were
+-- in initsql.sql. Run after 006_route_fingerprint.sql, which reads data.
+--
+-- The table is rewritten, so this takes a while on large databases. Space of data is reclaimed by
+-- VACUUM FULL StarPing_MTRData; afterwards.
+
+ALTER TABLE StarPing_MTRData
+    ADD COLUMN hop_index smallint[],
+    ADD COLUMN hop_timeout bool[],
+    ADD COLUMN hop_ip inet[],
+    ADD COLUMN hop_rdns text[],
+    ADD COLUMN hop_code smallint[],
+    ADD COLUMN hop_avg real[],
+    ADD COLUMN hop_min real[],
+    ADD COLUMN hop_max real[],
+    ADD COLUMN hop_std_dev real[],
+    ADD COLUMN hop_drop smallint[],
+    ADD COLUMN hop_total smallint[],
+    ADD COLUMN hop_extra jsonb,
+    ADD COLUMN hop_extra_ip inet[];
+
+-- Same split as database.hop_columns.
+UPDATE StarPing_MTRData d SET (hop_index, hop_timeout, hop_ip, hop_rdns, hop_code, hop_avg, hop_min, hop_max,
+                               hop_std_dev, hop_drop, hop_total, hop_extra) = (
+    SELECT coalesce(array_agg((hop->>'index')::smallint ORDER BY n), '{}'),
+           coalesce(array_agg((hop->>'timeout')::bool ORDER BY n), '{}'),
+           coalesce(array_agg((hop->'addr'->0->>'ip')::inet ORDER BY n), '{}'),
+           coalesce(array_agg(hop->'addr'->0->>'rdns' ORDER BY n), '{}'),
+           coalesce(array_agg((hop->'addr'->0->>'code')::smallint ORDER BY n), '{}'),
+           coalesce(array_agg((hop->>'avg')::real ORDER BY n), '{}'),
+           coalesce(array_agg((hop->>'min')::real ORDER BY n), '{}'),
+           coalesce(array_agg((hop->>'max')::real ORDER BY n), '{}'),
+           coalesce(array_agg((hop->>'std_dev')::real ORDER BY n), '{}'),
+           coalesce(array_agg((hop->>'drop')::smallint ORDER BY n), '{}'),
+           coalesce(array_agg((hop->>'total')::smallint ORDER BY n), '{}'),
+           jsonb_object_agg((n - 1)::text, (hop->'addr') - 0) FILTER (WHERE CASE
+               WHEN jsonb_typeof(hop->'addr') = 'array' THEN jsonb_array_length(hop->'addr') > 1 ELSE false END)
+    FROM jsonb_array_elements(d.data) WITH ORDINALITY e(hop, n)
+), hop_extra_ip = (
+    SELECT array_agg((a->>'ip')::inet ORDER BY e.n, x.m)
+    FROM jsonb_array_elements(d.data) WITH ORDINALITY e(hop, n),
+         jsonb_array_elements(CASE WHEN jsonb_typeof(e.hop->'addr') = 'array' THEN e.hop->'addr'
+                                   ELSE '[]'::jsonb END) WITH ORDINALITY x(a, m)
+    WHERE x.m > 1
+) WHERE data IS NOT NULL;
+
+ALTER TABLE StarPing_MTRData DROP COLUMN data;
+
+-- Routes going through an address, as hop_ip @> ARRAY[address] or hop_extra_ip @> ARRAY[address].
+CREATE INDEX StarPing_MTRData_IP_Index ON StarPing_MTRData USING gin (hop_ip);
+CREATE INDEX StarPing_MTRData_Extra_IP_Index ON StarPing_MTRData USING gin (hop_extra_ip);
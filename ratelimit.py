@@ -0,0 +1,81 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import ipaddress
+import time
+
+
+def client_key(remote_ip):
+    """Clients are limited by IPv4 address, or by IPv6 /64 network."""
+    addr = ipaddress.ip_address(remote_ip)
+    if isinstance(addr, ipaddress.IPv6Address):
+        return str(ipaddress.ip_interface(remote_ip + '/64').network)
+    return str(addr)
+
+
+class MemoryLimiter:
+    """Token bucket limiter held in process memory.
+
+    A client has `burst` tokens, spends one per request and gets one back every `duration`
+    seconds. Buckets full again are forgotten. They are found from a heap ordered by the time
+    they become full, so a request costs O(log n) instead of a scan over all clients."""
+
+    def __init__(self, name, duration=1, burst=1):
+        self.name = name
+        self.duration = duration
+        self.burst = burst
+        self.buckets = dict()
+        self.expiry = []
+
+    def expire(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            _, key = heapq.heappop(self.expiry)
+            bucket = self.buckets.get(key)
+            if bucket is not None and bucket[1] + (self.burst - bucket[0]) * self.duration <= now:
+                del self.buckets[key]
+
+    async def allow(self, key, db=None):
+        now = time.monotonic()
+        self.expire(now)
+        tokens, stamp = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - stamp) / self.duration)
+        if tokens < 1:
+            return False
+        tokens -= 1
+        self.buckets[key] = tokens, now
+        heapq.heappush(self.expiry, (now + (self.burst - tokens) * self.duration, key))
+        return True
+
+
+class DatabaseLimiter:
+    """Token bucket limiter kept in database, shared by all processes using the database.
+
+    Buckets are keyed by limiter name and client, so limiters of the same name share them."""
+
+    def __init__(self, name, duration=1, burst=1):
+        self.name = name
+        self.duration = duration
+        self.burst = burst
+
+    async def allow(self, key, db=None):
+        return await db.rate_limit(self.name, key, self.duration, self.burst)
+
+
+backends = {
+    'memory': MemoryLimiter,
+    'database': DatabaseLimiter,
+}
@@ -16,6 +16,7 @@
 
 import asyncio
 import platform
+import signal
 import functools
 import hashlib
 import hmac
@@ -27,9 +28,12 @@ import tornado.ioloop
 import tornado.web
 import tornado.httpserver
 import tornado.template
-from tornado.log import enable_pretty_logging
+import tornado.netutil
+import tornado.process
+from tornado.log import enable_pretty_logging, gen_log
 import asyncpg
 import database
+import metrics
 import config
 import credential
 
@@ -43,6 +47,12 @@ def first_true(i: Iterable[str]):
     return None
 
 
+hmac_failures = metrics.Counter('starping_hmac_failures_total', 'Node requests failing verification, by reason.',
+                                ('reason',))
+reports = metrics.Counter('starping_reports_total', 'Reports received, by type, node and result.',
+                          ('type', 'node', 'result'))
+
+
 def verify_hmac(data="body"):
     def _(async_func):
         @functools.wraps(async_func)
@@ -50,21 +60,24 @@ def verify_hmac(data="body"):
             self.set_header("Content-Type", "application/json")
             if 'X-StarPing-Name' not in self.request.headers \
                     or 'X-StarPing-Signature' not in self.request.headers:
+                hmac_failures.inc('absent')
                 self.set_status(403)
                 await self.finish('{"message": "Signature header absent."}')
                 return
             name = self.request.headers['X-StarPing-Name']
             # Take care of SQL injection
             if set(name) - config.safe_name:
+                hmac_failures.inc('malformed_name')
                 self.set_status(400)
                 await self.finish('{"message": "Malformed name."}')
                 return
             node = await self.settings['db'].get_secret(name)
             if not node:
+                hmac_failures.inc('unknown_node')
                 self.set_status(403)
                 await self.finish('{"message": "Not registered planet."}')
                 return
-            secret, typ = node['secret'].encode(), node['type']
+            secret, typ = node[0].encode(), node[1]
             verify_data = None
             if data == "body":
                 verify_data = self.request.body
@@ -75,12 +88,14 @@ def verify_hmac(data="body"):
                 else:
                     verify_data = first_true(self.request.headers[i] for i in fields if i in self.request.headers)
             if not verify_data:
+                hmac_failures.inc('unverifiable')
                 self.set_status(400)
                 await self.finish('{"message": "Can\'t verify node."}')
                 return
             if not hmac.compare_digest(
                     hmac.HMAC(secret, verify_data, hashlib.sha256).hexdigest(),
                     self.request.headers['X-StarPing-Signature']):
+                hmac_failures.inc('bad_signature')
                 self.set_status(403)
                 await self.finish('{"message": "Bad signature."}')
                 return
@@ -95,6 +110,118 @@ class DatabaseWarning(Warning):
     pass
 
 
+class IngestBuffer:
+    """Hold reports in memory and write them to database in bulk.
+
+    A flush happens every `flush_interval` seconds, or as soon as `flush_size` reports
+    are queued. At most `max_size` reports are held, and reporters wait for a flush
+    when the buffer is full.
+
+    In "commit" mode `put` returns after the report is committed, and reports the
+    reason if database refused it. In "enqueue" mode `put` returns once the report is
+    queued, and reports that fail to be stored are only logged."""
+
+    def __init__(self, db, mode="commit", max_size=100000, flush_size=1000, flush_interval=1):
+        if mode not in ('commit', 'enqueue'):
+            raise RuntimeError(f'"{mode}" is not a valid ingest mode.')
+        self.db = db
+        self.mode = mode
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = {'ping': [], 'mtr': []}
+        self.closed = False
+        self.full = asyncio.Event()
+        self.space = asyncio.Condition()
+        self.flushing = asyncio.Lock()
+
+    @property
+    def size(self):
+        return len(self.queue['ping']) + len(self.queue['mtr'])
+
+    def start(self):
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                gen_log.exception("Failed flushing ingest buffer.")
+
+    async def close(self):
+        self.closed = True
+        self.full.set()
+        await self.flush()
+
+    async def put(self, typ, node, p):
+        if self.closed:
+            return "Server is shutting down."
+        row, err = (self.db.parse_ping if typ == 'ping' else self.db.parse_mtr)(node, p)
+        if err is not None:
+            reports.inc(typ, node, 'rejected')
+            return err
+        if self.size >= self.max_size:
+            self.full.set()
+            async with self.space:
+                await self.space.wait_for(lambda: self.size < self.max_size)
+        future = asyncio.get_running_loop().create_future() if self.mode == 'commit' else None
+        self.queue[typ].append((row, future))
+        if self.size >= self.flush_size:
+            self.full.set()
+        if future is not None:
+            return await future
+
+    async def flush(self):
+        async with self.flushing:
+            self.full.clear()
+            pings, mtrs = self.queue['ping'], self.queue['mtr']
+            self.queue = {'ping': [], 'mtr': []}
+            async with self.space:
+                self.space.notify_all()
+            if not pings and not mtrs:
+                return
+            try:
+                try:
+                    ping_rejected, mtr_rejected = await self.db.store_reports([i[0] for i in pings],
+                                                                              [i[0] for i in mtrs])
+                except Exception as e:
+                    if self.mode == 'commit':
+                        for typ, queued in (('ping', pings), ('mtr', mtrs)):
+                            for row, future in queued:
+                                reports.inc(typ, row[0], 'failed')
+                                future.set_exception(e)
+                        gen_log.warning(f"Failed storing {len(pings) + len(mtrs)} reports: {e!r}")
+                    else:
+                        # Nobody waits for these reports. Give them another chance in next flush if there is room.
+                        room = self.max_size - self.size
+                        self.queue['ping'][:0] = pings[:room]
+                        self.queue['mtr'][:0] = mtrs[:max(room - len(pings), 0)]
+                        for typ, dropped in (('ping', pings[room:]), ('mtr', mtrs[max(room - len(pings), 0):])):
+                            for row, _ in dropped:
+                                reports.inc(typ, row[0], 'failed')
+                        gen_log.warning(f"Failed storing {len(pings) + len(mtrs)} reports "
+                                        f"({max(len(pings) + len(mtrs) - room, 0)} dropped): {e!r}")
+                    return
+                for typ, queued, rejected in (('ping', pings, ping_rejected), ('mtr', mtrs, mtr_rejected)):
+                    rejected = dict(rejected)
+                    for index, (row, future) in enumerate(queued):
+                        reports.inc(typ, row[0], 'rejected' if index in rejected else 'stored')
+                        if future is not None:
+                            future.set_result(rejected.get(index))
+                        elif index in rejected:
+                            gen_log.warning(f"Dropped report from '{row[0]}': {rejected[index]}")
+            finally:
+                # Never leave a reporter waiting, whatever went wrong above.
+                for _, future in pings + mtrs:
+                    if future is not None and not future.done():
+                        future.set_exception(RuntimeError("Report was not stored."))
+
+
 class ConfigHandler(tornado.web.RequestHandler):
     @verify_hmac('header')
     async def get(self, name, typ):
@@ -105,14 +232,23 @@ class ConfigHandler(tornado.web.RequestHandler):
             warnings.warn(f"No target configured for {typ} '{name}'. Is database inconsistent?", DatabaseWarning)
             return
         ping_config, mtr_config = config.get_config()
+        # Version of the whole config. Nodes polling with it, as `version` argument or
+        # If-None-Match header, get 304 until something changes.
+        version = hashlib.sha1(json.dumps([ping_config, mtr_config, ping_targets, mtr_targets]).encode()).hexdigest()
+        self.set_header('Etag', f'"{version}"')
+        if self.get_argument('version', None) == version or self.check_etag_header():
+            self.set_status(304)
+            return
         if 'update' in self.request.arguments:
             data = json.dumps({
+                "version": version,
                 "ping_targets": ping_targets,
                 "mtr_targets": mtr_targets
             }).encode()
             self.write(data)
         else:
             data = json.dumps({
+                "version": version,
                 "ping_config": ping_config,
                 "mtr_config": mtr_config,
                 "ping_targets": ping_targets,
@@ -129,14 +265,22 @@ class ReportHandler(tornado.web.RequestHandler):
                 if self.request.arguments['type'] == [b'ping']:
                     if typ == 'planet':
                         p = json.loads(self.request.body)
-                        await self.settings['db'].ping_record(name, p)
+                        err = await self.settings['ingest'].put('ping', name, p)
+                        if err is not None:
+                            self.set_status(400)
+                            await self.finish('{"message": "' + err + '"}')
                     else:
                         print(f'Bad request: {self.request.arguments["type"]}')
                         self.set_status(400)
                         await self.finish('{"message": "Comets shouldn\'t report ping records."}')
                 elif self.request.arguments['type'] == [b'mtr']:
                     p = json.loads(self.request.body)
-                    await self.settings['db'].mtr_record(name, p)
+                    err = await self.settings['ingest'].put('mtr', name, p)
+                    if err is not None:
+                        self.set_status(400)
+                        await self.finish('{"message": "' + err + '"}')
+                elif self.request.arguments['type'] == [b'batch']:
+                    await self.batch(name, typ, json.loads(self.request.body))
                 else:
                     print(f'Bad request: {self.request.arguments["type"]}')
                     self.set_status(400)
@@ -153,25 +297,93 @@ class ReportHandler(tornado.web.RequestHandler):
             self.set_status(400)
             await self.finish('{"message": "No type specified."}')
 
+    async def batch(self, name, typ, p):
+        """Store a batch report of form {"ping": [report, ...], "mtr": [report, ...]}.
+
+        Entries are checked one by one, and the ones refused are listed in the response
+        instead of failing the whole batch."""
+        if not isinstance(p, dict) or not all(isinstance(p.get(i, []), list) for i in ('ping', 'mtr')):
+            self.set_status(400)
+            await self.finish('{"message": "Bad batch report."}')
+            return
+        pings, mtrs = p.get('ping', []), p.get('mtr', [])
+        rejected = []
+        if pings and typ != 'planet':
+            rejected.extend({"type": "ping", "index": i, "message": "Comets shouldn't report ping records."}
+                            for i in range(len(pings)))
+            pings = []
+        rows = {'ping': ([], []), 'mtr': ([], [])}
+        for kind, entries, parse in (('ping', pings, self.settings['db'].parse_ping),
+                                     ('mtr', mtrs, self.settings['db'].parse_mtr)):
+            for index, report in enumerate(entries):
+                row, err = parse(name, report)
+                if err is not None:
+                    rejected.append({"type": kind, "index": index, "message": err})
+                else:
+                    rows[kind][0].append(index)
+                    rows[kind][1].append(row)
+        if rows['ping'][1] or rows['mtr'][1]:
+            stored = await self.settings['db'].store_reports(rows['ping'][1], rows['mtr'][1])
+            for kind, refused in zip(('ping', 'mtr'), stored):
+                rejected.extend({"type": kind, "index": rows[kind][0][i], "message": err} for i, err in refused)
+                reports.inc(kind, name, 'stored', amount=len(rows[kind][1]) - len(refused))
+        for kind in ('ping', 'mtr'):
+            refused = sum(1 for i in rejected if i['type'] == kind)
+            if refused:
+                reports.inc(kind, name, 'rejected', amount=refused)
+        self.write(json.dumps({
+            "accepted": len(p.get('ping', [])) + len(mtrs) - len(rejected),
+            "rejected": rejected
+        }).encode())
+
 
 class ReloadHandler(tornado.web.RequestHandler):
     async def get(self):
         if self.request.remote_ip == '127.0.0.1' or self.request.remote_ip == '::1':
-            self.settings['db'].refresh_cache()
+            # Reaches every process of both servers, not only the one serving this request.
+            await self.settings['db'].announce_reload()
 
 
 application = tornado.web.Application([
     (r'/nodes/api/report', ReportHandler),
     (r'/nodes/api/config', ConfigHandler),
-    (rf'/nodes/api/reload/{credential.reload_key}', ReloadHandler)
-])
+    (rf'/nodes/api/reload/{credential.reload_key}', ReloadHandler),
+    (r'/metrics', metrics.MetricsHandler),
+    (r'/admin/slow', metrics.SlowCallsHandler),
+], log_function=metrics.log_request)
 
 
 if __name__ == "__main__":
+    # Workers are forked before any event loop or connection is made, and share the listening socket.
+    sockets = tornado.netutil.bind_sockets(4080)
+    if config.server_config["report_workers"] != 1:
+        tornado.process.fork_processes(config.server_config["report_workers"])
     if platform.system() == "Windows":
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     event_loop = asyncio.get_event_loop()
-    application.settings['db'] = event_loop.run_until_complete(database.get_db())
+    application.settings['db'] = event_loop.run_until_complete(
+        database.get_db(database.pool_size(config.server_config["report_workers"])))
+    application.settings['ingest'] = IngestBuffer(application.settings['db'], **config.ingest_config)
+    application.settings['ingest'].start()
+    # Rollups and partitions are maintained by the first worker only.
+    if not tornado.process.task_id():
+        tornado.ioloop.PeriodicCallback(application.settings['db'].update_rollup,
+                                        config.rollup_config["interval"] * 1000).start()
+        event_loop.run_until_complete(application.settings['db'].maintain_partitions())
+        tornado.ioloop.PeriodicCallback(application.settings['db'].maintain_partitions,
+                                        config.partition_config["interval"] * 1000).start()
     server = tornado.httpserver.HTTPServer(application, xheaders=True)
-    server.listen(4080)
+    server.add_sockets(sockets)
+
+    async def shutdown():
+        server.stop()
+        await application.settings['ingest'].close()
+        tornado.ioloop.IOLoop.current().stop()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            event_loop.add_signal_handler(sig, lambda: event_loop.create_task(shutdown()))
+        except NotImplementedError:
+            # Windows event loop doesn't support signal handlers. Reports still in buffer may be lost.
+            pass
     tornado.ioloop.IOLoop.current().start()
@@ -14,9 +14,134 @@
 // You should have received a copy of the GNU General Public License
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+const columnarType = "application/x-starping-columnar";
+
+// Decode a chart API response in columnar encoding into the same shape as its JSON response.
+// See columnar.py for the layout.
+function decodeColumnar(buffer) {
+    const view = new DataView(buffer);
+    const length = view.getUint32(0, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, length)));
+    let offset = 4 + length;
+
+    function column(c) {
+        const values = new Array(c.count);
+        let size;
+        if (c.column === "bitmap") {
+            for (let i = 0; i < c.count; i++) {
+                values[i] = (view.getUint8(offset + (i >> 3)) >> (i & 7) & 1) === 1;
+            }
+            size = (c.count + 7) >> 3;
+        } else if (c.column === "delta") {
+            let value = c.base;
+            for (let i = 0; i < c.count; i++) {
+                value += view.getUint32(offset + 4 * i, true);
+                values[i] = value;
+            }
+            size = 4 * c.count;
+        } else {
+            for (let i = 0; i < c.count; i++) {
+                const value = view.getFloat32(offset + 4 * i, true);
+                values[i] = isNaN(value) ? null : value;
+            }
+            size = 4 * c.count;
+        }
+        offset += (size + 3) & ~3;
+        return values;
+    }
+
+    function walk(value) {
+        if (Array.isArray(value)) return value.map(walk);
+        if (value === null || typeof value !== "object") return value;
+        if (value.column !== undefined) return column(value);
+        if (value.keys !== undefined && value.values !== undefined) {
+            // Walk values in the order they were encoded, which object key order does not keep for keys like "1".
+            const values = walk(value.values);
+            const result = {};
+            value.keys.forEach(function (key, i) {
+                result[key] = values[i];
+            });
+            return result;
+        }
+        for (const key in value) value[key] = walk(value[key]);
+        if (value.rows !== undefined) {
+            const names = Object.keys(value.rows);
+            const count = names.length ? value.rows[names[0]].length : 0;
+            const rows = new Array(count);
+            for (let i = 0; i < count; i++) {
+                rows[i] = {};
+                for (const name of names) rows[i][name] = value.rows[name][i];
+            }
+            return rows;
+        }
+        return value;
+    }
+
+    return walk(header);
+}
+
+// Get a chart API, in columnar encoding if the browser is able to decode it.
+// failed is called on any other error response, network or decoding error.
+function getSeries(url, params, success, tooManyRequests = null, failed = null) {
+    if (!window.fetch || !window.TextDecoder) {
+        $.ajax(url, {
+            data: params, dataType: "json", success: success, error: function (xhr) {
+                if (xhr.status === 429) {
+                    if (tooManyRequests) tooManyRequests();
+                } else {
+                    console.log("Failed loading " + url + ": " + xhr.status);
+                    if (failed) failed();
+                }
+            }
+        });
+        return;
+    }
+    let limited = false;
+    fetch(url + "?" + $.param(params), {headers: {"Accept": columnarType}}).then(function (response) {
+        if (response.status === 429) {
+            limited = true;
+        } else if (!response.ok) {
+            throw new Error("status " + response.status);
+        } else if (response.headers.get("Content-Type") === columnarType) {
+            return response.arrayBuffer().then(decodeColumnar);
+        } else {
+            return response.json();
+        }
+    }).then(function (data) {
+        if (!limited) {
+            success(data);
+        } else if (tooManyRequests) {
+            tooManyRequests();
+        }
+    }, function (e) {
+        console.log("Failed loading " + url + ": " + e);
+        if (failed) failed();
+    });
+}
+
+// Receive new records pushed by server through /api/live instead of polling.
+// The EventSource is kept on the chart, and closed when the chart is replaced.
+// catchUp polls records since the newest shown. It is called when the stream reconnects,
+// and when server sends a "resync" event as it had to drop records.
+function subscribeLive(chart, params, update, catchUp) {
+    if (!window.EventSource) return;
+    let opened = false;
+    chart.live = new EventSource("/api/live?" + $.param(params));
+    chart.live.onmessage = function (e) {
+        update(JSON.parse(e.data));
+    };
+    chart.live.onopen = function () {
+        // The first open follows loading the chart, there is nothing to catch up yet.
+        if (opened) catchUp();
+        opened = true;
+    };
+    chart.live.addEventListener("resync", catchUp);
+}
+
 function setChartGlance(eid, oldChart = null, oldInterval = null, target_name, target_sname, span) {
     span = parseInt(span);
     if (oldChart != null) {
+        if (oldChart.live) oldChart.live.close();
         oldChart.clear();
         oldChart.dispose()
     }
@@ -177,123 +302,134 @@ function setChartGlance(eid, oldChart = null, oldInterval = null, target_name, t
     let now = (new Date()).getTime() / 1000;
 
     let failed = true;
+    let interval = null;
 
-    $.ajax(span === 1 ? "/api/record" : "/api/record/longterm",
-        {
-            data: span === 1 ? {
-                "target": target_name
-            } : {
+    function poll() {
+        getSeries("/api/record",
+            {
                 "target": target_name,
-                "span": span
+                "update": true,
+                "stamp": newstamp
             },
-            dataType: "json",
-            success: function (data) {
-                let series = [];
-                for (let node of data) {
-                    let set_data = [];
-                    nodeindex[node.name] = index;
-                    index++;
-                    if (node.data != null) {
-                        for (let record of node.data) {
-                            if (record["timeout"]) {
-                                set_data.push([record["stamp"], null])
-                            } else {
-                                set_data.push([record["stamp"], record["avg"]])
-                            }
-                        }
-                    }
-                    series.push({
-                        id: nodeindex[node.name],
-                        type: 'line',
-                        name: node.shown_name,
-                        smooth: true,
-                        animation: true,
-                        data: set_data,
-                        showSymbol: $(window).width() > 1024 && span === 1,
-                    });
-                    if (node.data != null) {
-                        newest[node.name] = set_data[set_data.length - 1][0];
+            update);
+    }
+
+    function update(data) {
+        let now = (new Date()).getTime() / 1000;
+        let series = [];
+        for (let node of data) {
+            let set_data = [];
+
+            if (nodeindex[node.name] !== undefined) {
+                set_data = option.series[nodeindex[node.name]].data;
+            }
+            if (node.data != null) {
+                for (let record of node.data) {
+                    if (newest[node.name] >= record["stamp"]) continue;
+                    if (record["timeout"]) {
+                        set_data.push([record["stamp"], null])
                     } else {
-                        newest[node.name] = now;
+                        set_data.push([record["stamp"], record["avg"]])
+                    }
+                    if (set_data.length > max_point) {
+                        set_data = set_data.slice(set_data.length - max_point)
                     }
-                }
-                newstamp = Math.min.apply(null, Object.values(newest)) + 1;
-                option.series = series;
-                myChart.setOption(option);
-                console.log("Loaded. Newest: " + newstamp);
-                failed = false;
-                myChart.hideLoading();
-            },
-            statusCode: {
-                429: function () {
-                    let toastHTML = '<span>Whoa, you operates too fast. Please wait a moment.</span>';
-                    M.toast({html: toastHTML});
-                    myChart.clear();
-                    myChart.dispose();
                 }
             }
-        });
-
-    if (failed) {
-        return [null, null]
+            series.push({
+                id: nodeindex[node.name],
+                type: 'line',
+                name: node.shown_name,
+                smooth: true,
+                animation: true,
+                data: set_data,
+                showSymbol: $(window).width() > 1024,
+            });
+            if (node.data != null) {
+                newest[node.name] = set_data[set_data.length - 1][0];
+            } else {
+                newest[node.name] = now;
+            }
+        }
+        let newOption = {series: series};
+        myChart.setOption(newOption);
+        newstamp = Math.min.apply(null, Object.values(newest)) + 1;
+        console.log("Updated. Newest: " + newstamp);
     }
 
-    return [setInterval(function () {
-        let now = (new Date()).getTime() / 1000;
-
-        $.getJSON("/api/record",
-            {
-                "target": target_name,
-                "update": true,
-                "stamp": newstamp
-            },
-            function (data) {
-                let series = [];
-                for (let node of data) {
-                    let set_data = [];
-
-                    if (nodeindex[node.name] !== undefined) {
-                        set_data = option.series[nodeindex[node.name]].data;
-                    }
-                    if (node.data != null) {
-                        for (let record of node.data) {
-                            if (newest[node.name] >= record["stamp"]) continue;
-                            if (record["timeout"]) {
-                                set_data.push([record["stamp"], null])
-                            } else {
-                                set_data.push([record["stamp"], record["avg"]])
-                            }
-                            if (set_data.length > max_point) {
-                                set_data = set_data.slice(set_data.length - max_point)
-                            }
+    getSeries(span === 1 ? "/api/record" : "/api/record/longterm",
+        span === 1 ? {
+            "target": target_name
+        } : {
+            "target": target_name,
+            "span": span,
+            // No more points than pixels are drawn anyway.
+            "points": Math.max(document.getElementById(eid).clientWidth, 300)
+        },
+        function (data) {
+            let series = [];
+            for (let node of data) {
+                let set_data = [];
+                nodeindex[node.name] = index;
+                index++;
+                if (node.data != null) {
+                    for (let record of node.data) {
+                        if (record["timeout"]) {
+                            set_data.push([record["stamp"], null])
+                        } else {
+                            set_data.push([record["stamp"], record["avg"]])
                         }
                     }
-                    series.push({
-                        id: nodeindex[node.name],
-                        type: 'line',
-                        name: node.shown_name,
-                        smooth: true,
-                        animation: true,
-                        data: set_data,
-                        showSymbol: $(window).width() > 1024,
-                    });
-                    if (node.data != null) {
-                        newest[node.name] = set_data[set_data.length - 1][0];
-                    } else {
-                        newest[node.name] = now;
-                    }
                 }
-                let newOption = {series: series};
-                myChart.setOption(newOption);
-                newstamp = Math.min.apply(null, Object.values(newest)) + 1;
-                console.log("Updated. Newest: " + newstamp);
-            });
-    }, 60 * 1000 + 1), myChart]
+                series.push({
+                    id: nodeindex[node.name],
+                    type: 'line',
+                    name: node.shown_name,
+                    smooth: true,
+                    animation: true,
+                    data: set_data,
+                    showSymbol: $(window).width() > 1024 && span === 1,
+                });
+                if (node.data != null) {
+                    newest[node.name] = set_data[set_data.length - 1][0];
+                } else {
+                    newest[node.name] = now;
+                }
+            }
+            newstamp = Math.min.apply(null, Object.values(newest)) + 1;
+            option.series = series;
+            myChart.setOption(option);
+            console.log("Loaded. Newest: " + newstamp);
+            failed = false;
+            myChart.hideLoading();
+            subscribeLive(myChart, {"target": target_name}, update, poll);
+        },
+        function () {
+            let toastHTML = '<span>Whoa, you operates too fast. Please wait a moment.</span>';
+            M.toast({html: toastHTML});
+            if (interval != null) clearInterval(interval);
+            myChart.clear();
+            myChart.dispose();
+        });
+
+    if (window.EventSource) {
+        // With EventSource, updates are pushed to update() by subscribeLive.
+        return [null, myChart]
+    }
+
+    // The chart loads asynchronously, so polling starts right away and skips until it is loaded.
+    interval = setInterval(function () {
+        if (!failed) poll();
+    }, 60 * 1000 + 1);
+    return [interval, myChart]
 }
 
-function setChartDetail(eid, oldChart = null, oldInterval = null, target_name, target_sname, node_name, node_sname, span) {
+// preloaded is the first load of the chart when already fetched, as from /api/detailRecord/batch.
+function setChartDetail(eid, oldChart = null, oldInterval = null, target_name, target_sname, node_name, node_sname, span,
+                        preloaded = null) {
     span = parseInt(span);
     if (oldChart != null) {
+        if (oldChart.live) oldChart.live.close();
         oldChart.clear();
         oldChart.dispose()
     }
@@ -304,7 +440,7 @@ function setChartDetail(eid, oldChart = null, oldInterval = null, target_name, t
     myChart.showLoading();
 
     const max_point = 1440 * span;
-    const gap = 60;
+    let gap = 60;
 
     let avg = [], min = [], max = [];
 
@@ -354,7 +490,8 @@ function setChartDetail(eid, oldChart = null, oldInterval = null, target_name, t
                         'Lowest: ' + params[1].value[1].toFixed(2) + 'ms<br />' +
                         'Highest: ' + (params[1].value[1] + params[2].value[1]).toFixed(2) + 'ms<br />' +
                         'SDeviation: ' + (params[2].value[2]).toFixed(2) + 'ms<br />' +
-                        'Dropped: ' + params[2].value[3] + '/' + params[2].value[4] + '<br />';
+                        'Dropped: ' + params[2].value[3] + '/' + params[2].value[4] + '<br />' +
+                        (params[0].value[3] ? 'Timed out: ' + (params[0].value[3] * 100).toFixed(0) + '%<br />' : '');
                 } else {
                     return dword + ' ' + time + '<br />' +
                         'Timeout.<br />' +
@@ -552,153 +689,223 @@ function setChartDetail(eid, oldChart = null, oldInterval = null, target_name, t
     let out_start;
     let out_range = [];
     let failed = true;
+    let interval = null;
 
-    $.ajax(span === 1 ? "/api/detailRecord" : "/api/detailRecord/longterm",
-        {
-            data: span === 1 ? {
-                "node": node_name,
-                "target": target_name
-            } : {
+    function poll() {
+        getSeries("/api/detailRecord",
+            {
                 "node": node_name,
                 "target": target_name,
-                "span": span
+                "update": true,
+                "stamp": newest
             },
-            dataType: "json",
-            success: function (data) {
-                let t = 0;
-                if (data.time == null) {
-                    let toastHTML = '<span>Oops. Seems there\'s no data now.</span><button class="btn-flat toast-action" onClick="goBack()">Back</button>';
-                    M.toast({html: toastHTML});
-                    myChart.clear();
-                    myChart.dispose();
-                    return
+            update);
+    }
+
+    function update(data) {
+        if (data.time == null || data.time[data.time.length - 1] <= newest) {
+            console.log("Newest. Newest: " + newest);
+            return
+        }
+        // A poll catching up and pushed records may overlap.
+        const skip = data.time.findIndex(function (t) {
+            return t > newest;
+        });
+        if (skip > 0) {
+            for (const key in data) {
+                if (Array.isArray(data[key])) data[key] = data[key].slice(skip);
+            }
+        }
+        if (out) {
+            out_range = option.series[2].markArea.data.slice(0, -1);
+        } else {
+            out_range = option.series[2].markArea.data;
+        }
+        let avg = option.series[0].data;
+        let min = option.series[1].data;
+        let max = option.series[2].data;
+        let start = avg.length + data.time.length - max_point;
+        if (start < 0) start = 0;
+        let t = 0;
+        for (let i = 0; i < data.time.length; i++) {
+            if (data.avg[i] !== 0) {
+                if (out) {
+                    out_range.push([{xAxis: out_start}, {xAxis: data.time[i]}]);
+                    out = false;
                 }
-                for (let i = 0; i < data.time.length; i++) {
-                    if (data.avg[i] !== 0) {
-                        if (out) {
-                            out_range.push([{xAxis: out_start}, {xAxis: data.time[i]}]);
-                            out = false;
-                        }
-                        if (t !== 0 && data.time[i] - t > 1.1 * gap) {
-                            avg.push([avg[avg.length - 1][0] + gap, null, avg[avg.length - 1][2]]);
-                            min.push([min[min.length - 1][0] + gap, null]);
-                            max.push([max[max.length - 1][0] + gap, null, null, null, null]);
-                            avg.push([data.time[i] - gap, null, data.timeout[i]]);
-                            min.push([data.time[i] - gap, null]);
-                            max.push([data.time[i] - gap, null, null, null, null])
-                        }
-                        avg.push([data.time[i], data.avg[i], data.timeout[i]]);
-                        min.push([data.time[i], data.min[i]]);
-                        max.push([data.time[i], data.max[i] - data.min[i], data.std_dev[i], data.drop[i], data.total[i]])
-                    } else {
-                        if (!out) {
-                            out_start = data.time[i - 1];
-                            out = true;
-                        }
-                        avg.push([data.time[i], null, data.timeout[i]]);
-                        min.push([data.time[i], null]);
-                        max.push([data.time[i], null, null, data.drop[i], data.total[i]])
-                    }
-                    t = data.time[i]
+                if (t !== 0 && data.time[i] - t > gap) {
+                    avg.push([avg[avg.length - 1][0] + gap, null, avg[avg.length - 1][2]]);
+                    min.push([min[min.length - 1][0] + gap, null]);
+                    max.push([max[max.length - 1][0] + gap, null, null, null, null]);
+                    avg.push([data.time[i] - gap, null, data.timeout[i]]);
+                    min.push([data.time[i] - gap, null]);
+                    max.push([data.time[i] - gap, null, null, null, null])
                 }
+                avg.push([data.time[i], data.avg[i], data.timeout[i]]);
+                min.push([data.time[i], data.min[i]]);
+                max.push([data.time[i], data.max[i] - data.min[i], data.std_dev[i], data.drop[i], data.total[i]])
+            } else {
+                if (!out) {
+                    out_start = data.time[i];
+                    out = true;
+                }
+                avg.push([data.time[i], null, data.timeout[i]]);
+                min.push([data.time[i], null]);
+                max.push([data.time[i], null, null, data.drop[i], data.total[i]])
+            }
+            t = data.time[i]
+        }
+        if (out) {
+            out_range.push([{xAxis: out_start}, {xAxis: avg[avg.length - 1][0]}]);
+        }
+        avg = avg.slice(start);
+        min = min.slice(start);
+        max = max.slice(start);
+        let newOption = {
+            series: [
+                {
+                    data: avg,
+                }, {
+                    data: min,
+                }, {
+                    data: max,
+                    markArea: {
+                        data: out_range
+                    }
+                }]
+        };
+        myChart.setOption(newOption);
+        newest = avg[avg.length - 1][0];
+        console.log("Updated. Newest: " + newest);
+    }
+
+    function load(data) {
+        let t = 0;
+        if (data.time == null) {
+            let toastHTML = '<span>Oops. Seems there\'s no data now.</span><button class="btn-flat toast-action" onClick="goBack()">Back</button>';
+            M.toast({html: toastHTML});
+            myChart.clear();
+            myChart.dispose();
+            return
+        }
+        // Long spans are served from rollups, whose points are step seconds apart.
+        if (data.step != null) gap = data.step;
+        for (let i = 0; i < data.time.length; i++) {
+            if (data.avg[i] !== 0) {
                 if (out) {
-                    out_range.push([{xAxis: out_start}, {xAxis: avg[avg.length - 1][0]}]);
+                    out_range.push([{xAxis: out_start}, {xAxis: data.time[i]}]);
+                    out = false;
                 }
-                option.series[2].markArea.data = out_range;
-                newest = avg[avg.length - 1][0];
-                myChart.setOption(option);
-                console.log("Loaded. Newest: " + newest);
-                failed = false;
-                myChart.hideLoading();
-            },
-            statusCode: {
-                429: function () {
-                    let toastHTML = '<span>Whoa, you operates too fast. Please wait a moment.</span>';
-                    M.toast({html: toastHTML});
-                    myChart.clear();
-                    myChart.dispose();
+                if (t !== 0 && data.time[i] - t > 1.1 * gap) {
+                    avg.push([avg[avg.length - 1][0] + gap, null, avg[avg.length - 1][2]]);
+                    min.push([min[min.length - 1][0] + gap, null]);
+                    max.push([max[max.length - 1][0] + gap, null, null, null, null]);
+                    avg.push([data.time[i] - gap, null, data.timeout[i]]);
+                    min.push([data.time[i] - gap, null]);
+                    max.push([data.time[i] - gap, null, null, null, null])
+                }
+                // Rollups tell the share of records timed out in a bucket.
+                avg.push([data.time[i], data.avg[i], data.timeout[i], data.timeouts ? data.timeouts[i] : null]);
+                min.push([data.time[i], data.min[i]]);
+                max.push([data.time[i], data.max[i] - data.min[i], data.std_dev[i], data.drop[i], data.total[i]])
+            } else {
+                if (!out) {
+                    out_start = data.time[i - 1];
+                    out = true;
                 }
+                avg.push([data.time[i], null, data.timeout[i]]);
+                min.push([data.time[i], null]);
+                max.push([data.time[i], null, null, data.drop[i], data.total[i]])
             }
-        });
+            t = data.time[i]
+        }
+        if (out) {
+            out_range.push([{xAxis: out_start}, {xAxis: avg[avg.length - 1][0]}]);
+        }
+        option.series[2].markArea.data = out_range;
+        newest = avg[avg.length - 1][0];
+        myChart.setOption(option);
+        console.log("Loaded. Newest: " + newest);
+        failed = false;
+        myChart.hideLoading();
+        subscribeLive(myChart, {"target": target_name, "node": node_name}, update, poll);
+    }
 
-    if (failed) {
-        return [null, null]
+    function tooManyRequests() {
+        let toastHTML = '<span>Whoa, you operates too fast. Please wait a moment.</span>';
+        M.toast({html: toastHTML});
+        if (interval != null) clearInterval(interval);
+        myChart.clear();
+        myChart.dispose();
     }
 
-    return [setInterval(function () {
-        $.getJSON("/api/detailRecord",
-            {
+    if (preloaded != null) {
+        load(preloaded);
+    } else {
+        getSeries(span === 1 ? "/api/detailRecord" : "/api/detailRecord/longterm",
+            span === 1 ? {
+                "node": node_name,
+                "target": target_name
+            } : {
                 "node": node_name,
                 "target": target_name,
-                "update": true,
-                "stamp": newest
+                "span": span
             },
-            function (data) {
-                if (data.time == null) {
-                    console.log("Newest. Newest: " + newest);
-                    return
-                }
-                if (out) {
-                    out_range = option.series[2].markArea.data.slice(0, -1);
+            load, tooManyRequests);
+    }
+
+    if (window.EventSource) {
+        // With EventSource, updates are pushed to update() by subscribeLive.
+        return [null, myChart]
+    }
+
+    // The chart loads asynchronously, so polling starts right away and skips until it is loaded.
+    interval = setInterval(function () {
+        if (!failed) poll();
+    }, 60 * 1000 + 1);
+    return [interval, myChart];
+}
+
+// Table of latest record of every node and target of a group, refreshed every minute.
+// Clicking a row calls select(target_name, target_sname).
+function setMatrix(eid, group_name, select) {
+    function load(data) {
+        const table = $("<table class='striped centered'></table>");
+        const head = $("<tr><th></th></tr>");
+        for (let node of data.nodes) head.append($("<th></th>").text(node.shown_name));
+        table.append($("<thead></thead>").append(head));
+        const body = $("<tbody></tbody>");
+        const now = Date.now() / 1000;
+        data.targets.forEach(function (target, i) {
+            const row = $("<tr style='cursor: pointer'></tr>").append($("<th></th>").text(target.shown_name));
+            row.click(function () {
+                select(target.name, target.shown_name);
+            });
+            data.nodes.forEach(function (node, j) {
+                const cell = $("<td></td>");
+                if (data.stamp[i][j] == null || now - data.stamp[i][j] > 5 * 60) {
+                    cell.text("-");
+                } else if (data.timeout[i][j]) {
+                    cell.text("Timeout").css("color", "#d94046");
                 } else {
-                    out_range = option.series[2].markArea.data;
-                }
-                let avg = option.series[0].data;
-                let min = option.series[1].data;
-                let max = option.series[2].data;
-                let start = avg.length + data.time.length - max_point;
-                if (start < 0) start = 0;
-                let t = 0;
-                for (let i = 0; i < data.time.length; i++) {
-                    if (data.avg[i] !== 0) {
-                        if (out) {
-                            out_range.push([{xAxis: out_start}, {xAxis: data.time[i]}]);
-                            out = false;
-                        }
-                        if (t !== 0 && data.time[i] - t > gap) {
-                            avg.push([avg[avg.length - 1][0] + gap, null, avg[avg.length - 1][2]]);
-                            min.push([min[min.length - 1][0] + gap, null]);
-                            max.push([max[max.length - 1][0] + gap, null, null, null, null]);
-                            avg.push([data.time[i] - gap, null, data.timeout[i]]);
-                            min.push([data.time[i] - gap, null]);
-                            max.push([data.time[i] - gap, null, null, null, null])
-                        }
-                        avg.push([data.time[i], data.avg[i], data.timeout[i]]);
-                        min.push([data.time[i], data.min[i]]);
-                        max.push([data.time[i], data.max[i] - data.min[i], data.std_dev[i], data.drop[i], data.total[i]])
-                    } else {
-                        if (!out) {
-                            out_start = data.time[i];
-                            out = true;
-                        }
-                        avg.push([data.time[i], null, data.timeout[i]]);
-                        min.push([data.time[i], null]);
-                        max.push([data.time[i], null, null, data.drop[i], data.total[i]])
+                    cell.text(data.avg[i][j].toFixed(1) + "ms");
+                    if (data.loss[i][j] > 0) {
+                        cell.append($("<small></small>").text(" " + (data.loss[i][j] * 100).toFixed(0) + "%"))
+                            .css("color", data.loss[i][j] > 0.1 ? "#d94046" : "#e1a127");
                     }
-                    t = data.time[i]
                 }
-                if (out) {
-                    out_range.push([{xAxis: out_start}, {xAxis: avg[avg.length - 1][0]}]);
-                }
-                avg = avg.slice(start);
-                min = min.slice(start);
-                max = max.slice(start);
-                let newOption = {
-                    series: [
-                        {
-                            data: avg,
-                        }, {
-                            data: min,
-                        }, {
-                            data: max,
-                            markArea: {
-                                data: out_range
-                            }
-                        }]
-                };
-                myChart.setOption(newOption);
-                newest = avg[avg.length - 1][0];
-                console.log("Updated. Newest: " + newest);
+                row.append(cell);
             });
-    }, 60 * 1000 + 1), myChart];
-}
\ No newline at end of file
+            body.append(row);
+        });
+        table.append(body);
+        $("#" + eid).empty().append(table);
+    }
+
+    function refresh() {
+        $.ajax("/api/groupMatrix", {data: {"group": group_name}, dataType: "json", success: load});
+    }
+
+    refresh();
+    return setInterval(refresh, 60 * 1000 + 1);
+}
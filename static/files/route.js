@@ -38,54 +38,79 @@ function getRoute(eid, target_name, node_name, time_after) {
             "time": time_after
         },
         function (timedata) {
-        if (timedata.time == null) {
-            $(eid).empty();
-            let toastHTML = '<span>Oops. There is no record after this time.</span>';
-            M.toast({html: toastHTML});
-        }
-            let time = timedata.time * 1000;
-            let data = timedata.data;
-            let s = '<div class="card-panel teal lighten-4">Route data at time ' + new Date(time) + '</div>' +
-                '<div style="overflow: auto"><table class="striped" style="min-width:500px">' +
-                '<thead><tr><th style="width:2%">#</th><th>IP</th>' +
-                '<th style="width:5%">Avg/ms</th><th style="width:5%">Min/ms</th><th style="width:5%">Max/ms</th>' +
-                '<th style="width:5%">SDev/ms</th><th style="width:5%">D/T</th></tr></thead><tbody>';
-            if (data.length === 0) {
-                s += '</tbody></table></div>';
+            if (timedata.time == null) {
                 $(eid).empty();
-                $(eid).append(s);
+                let toastHTML = '<span>Oops. There is no record after this time.</span>';
+                M.toast({html: toastHTML});
+                return
+            }
+            $(eid).empty();
+            $(eid).append(renderRoute('Route data at time ', timedata.time, timedata.data));
+            $('.with-rdns').tooltip();
+            if (timedata.data.length === 0) {
                 let toastHTML = '<span>Oops. MTR of that time was timed out.</span>';
                 M.toast({html: toastHTML});
-            } else {
-                for (let hop of data) {
-                    let l = '<tr><td style="width:2%">';
-                    l += hop['index'] + '</td>';
-                    if (hop['timeout']) {
-                        l += '<td>*</td><td></td><td></td><td></td><td></td><td></td></tr>';
-                        s += l;
-                    } else {
-                        l += renderAddr(hop['addr'][0]);
-                        l += '<td style="width:5%">' + hop['avg'].toFixed(2) + '</td>';
-                        l += '<td style="width:5%">' + hop['min'].toFixed(2) + '</td>';
-                        l += '<td style="width:5%">' + hop['max'].toFixed(2) + '</td>';
-                        l += '<td style="width:5%">' + hop['std_dev'].toFixed(2) + '</td>';
-                        l += '<td style="width:5%">' + hop['drop'] + '/' + hop['total'] + '</td></tr>';
-                        s += l;
-                        if (hop['addr'].length > 1) {
-                            for (let ex_addr of hop['addr'].slice(1))
-                                s += '<tr><td style="width:2%"> </td>' + renderAddr(ex_addr) + '</tr>';
-                        }
-                    }
-                }
-                s += '</tbody></table></div>';
-                $(eid).empty();
-                $(eid).append(s);
-                $('.with-rdns').tooltip();
             }
         });
     return true
 }
 
+// Routes taken in the last `hours` hours, each shown with the record where it was first seen.
+function getRouteHistory(eid, target_name, node_name, hours) {
+    const now = Date.now() / 1000;
+    $.getJSON("/api/route/range",
+        {
+            "target": target_name,
+            "node": node_name,
+            "start": now - hours * 60 * 60,
+            "end": now,
+            "changes": true
+        },
+        function (records) {
+            $(eid).empty();
+            if (records.length === 0) {
+                let toastHTML = '<span>Oops. There is no record in this span.</span>';
+                M.toast({html: toastHTML});
+                return
+            }
+            for (let record of records.reverse()) {
+                $(eid).append(renderRoute('Route ' + record.fingerprint + ' since ', record.time, record.data));
+            }
+            $('.with-rdns').tooltip();
+        });
+    return true
+}
+
+function renderRoute(title, time, data) {
+    let s = '<div class="card-panel teal lighten-4">' + title + new Date(time * 1000) + '</div>' +
+        '<div style="overflow: auto"><table class="striped" style="min-width:500px">' +
+        '<thead><tr><th style="width:2%">#</th><th>IP</th>' +
+        '<th style="width:5%">Avg/ms</th><th style="width:5%">Min/ms</th><th style="width:5%">Max/ms</th>' +
+        '<th style="width:5%">SDev/ms</th><th style="width:5%">D/T</th></tr></thead><tbody>';
+    for (let hop of data) {
+        let l = '<tr><td style="width:2%">';
+        l += hop['index'] + '</td>';
+        if (hop['timeout']) {
+            l += '<td>*</td><td></td><td></td><td></td><td></td><td></td></tr>';
+            s += l;
+        } else {
+            l += renderAddr(hop['addr'][0]);
+            l += '<td style="width:5%">' + hop['avg'].toFixed(2) + '</td>';
+            l += '<td style="width:5%">' + hop['min'].toFixed(2) + '</td>';
+            l += '<td style="width:5%">' + hop['max'].toFixed(2) + '</td>';
+            l += '<td style="width:5%">' + hop['std_dev'].toFixed(2) + '</td>';
+            l += '<td style="width:5%">' + hop['drop'] + '/' + hop['total'] + '</td></tr>';
+            s += l;
+            if (hop['addr'].length > 1) {
+                for (let ex_addr of hop['addr'].slice(1))
+                    s += '<tr><td style="width:2%"> </td>' + renderAddr(ex_addr) + '</tr>';
+            }
+        }
+    }
+    s += '</tbody></table></div>';
+    return s
+}
+
 function renderAddr(addr) {
     let l = '';
     if (addr['rdns'] !== "") {
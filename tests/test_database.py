@@ -0,0 +1,70 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+from unittest import mock
+
+import asyncpg
+
+import database
+
+
+class CacheVersionTest(unittest.TestCase):
+    def test_bumped_after_reload(self):
+        cache = database.Database.__new__(database.Database)
+        cache.cache_version = 0
+        seen = []
+
+        class Connection:
+            async def fetch(self, query):
+                await asyncio.sleep(0)
+                seen.append(cache.cache_version)
+                return [{'name': 'node', 'secret': 'secret', 'type': 'planet', 'shown_name': 'Node'}]
+
+        asyncio.run(cache._get_node_list(Connection()))
+        # A page rendered while fetching must not be kept under the new version.
+        self.assertEqual(seen, [0])
+        self.assertEqual(cache.cache_version, 1)
+        self.assertEqual(cache.nodes, {'node': ('secret', 'planet', 'Node')})
+
+
+class TracerTest(unittest.TestCase):
+    def test_records_queries(self):
+        tracer = database.Tracer(enabled=True, slow=0, explain=0)
+        connection = database.Connection.__new__(database.Connection)
+        # Not connected, which asyncpg checks when the connection is collected.
+        connection._aborted = True
+
+        class Statement:
+            async def fetchval(self, *args):
+                return 1
+
+        async def fetch(self, query, *args):
+            return []
+
+        connection.statements = {'get_ping_targets': Statement()}
+
+        async def run():
+            await connection.prepared('get_ping_targets', 'fetchval', 'planet', 'node')
+            return await connection.fetch('select 1;')
+
+        with mock.patch.object(asyncpg.Connection, 'fetch', fetch):
+            self.assertEqual(asyncio.run(tracer.call(None, connection, 'query', (), {}, 0, run)), [])
+        self.assertEqual([(i['query'], i['args']) for i in tracer.slow_calls[0]['queries']],
+                         [(database.statements['get_ping_targets'], "('planet', 'node')"), ('select 1;', '()')])
+        # Nothing is recorded out of traced calls.
+        self.assertIsNone(database.traced_queries.get())
@@ -0,0 +1,45 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import unittest
+
+import database
+import main
+
+
+class LatestTableTest(unittest.TestCase):
+    def setUp(self):
+        db = database.Database.__new__(database.Database)
+        db.cache_version = 0
+        db.nodes = {'a': ('secret', 'planet', 'A'), 'b': ('secret', 'planet', 'B'), 'c': ('secret', 'planet', 'C')}
+        db.ping_targets = {'t': ('T', ['planet'])}
+        db.group_info = {'g': ['t']}
+        self.table = main.LatestTable(db)
+
+    def matrix(self):
+        return json.loads(self.table.matrix('g').body)
+
+    def test_loss(self):
+        now = time.time()
+        self.table.update('a', 't', now, False, 10.0, 1, 4)
+        self.table.update('b', 't', now, True, None, None, None)
+        self.table.update('c', 't', now, True, None, 0, 0)
+        matrix = self.matrix()
+        self.assertEqual([i['name'] for i in matrix['nodes']], ['a', 'b', 'c'])
+        self.assertEqual(matrix['loss'], [[0.25, None, None]])
+        self.assertEqual(matrix['timeout'], [[False, True, True]])
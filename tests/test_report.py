@@ -0,0 +1,88 @@
+# StarPing Star
+# Copyright (C) 2020  Yuan Tong
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import hmac
+import json
+
+import tornado.testing
+import tornado.web
+
+import report
+
+
+class FakeDatabase:
+    """Nodes, parsing and storing of reports, without a database. Reports with "bad" set fail to parse,
+    and the ones with "refused" set are refused when stored."""
+
+    secret = 'secret'
+
+    def __init__(self):
+        self.stored = {'ping': [], 'mtr': []}
+
+    async def get_secret(self, name):
+        return self.secret, 'planet'
+
+    @staticmethod
+    def parse(node, p):
+        if p.get('bad'):
+            return None, "Bad report value."
+        return (node, p), None
+
+    parse_ping = parse_mtr = parse
+
+    async def store_reports(self, pings, mtrs):
+        result = []
+        for kind, rows in (('ping', pings), ('mtr', mtrs)):
+            refused = [(i, "Bad report value.") for i, row in enumerate(rows) if row[1].get('refused')]
+            self.stored[kind].extend(row for i, row in enumerate(rows) if row[1].get('refused') is None)
+            result.append(refused)
+        return result
+
+
+class BatchReportTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.db = FakeDatabase()
+        return tornado.web.Application([(r'/nodes/api/report', report.ReportHandler)], db=self.db)
+
+    def post_batch(self, name, batch):
+        body = json.dumps(batch).encode()
+        signature = hmac.HMAC(FakeDatabase.secret.encode(), body, hashlib.sha256).hexdigest()
+        return self.fetch('/nodes/api/report?type=batch', method='POST', body=body,
+                          headers={'X-StarPing-Name': name, 'X-StarPing-Signature': signature})
+
+    def count(self, *labels):
+        return report.reports.values.get(labels, 0)
+
+    def test_good_batch(self):
+        response = self.post_batch('good', {"ping": [{}, {}], "mtr": [{}]})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {"accepted": 3, "rejected": []})
+        self.assertEqual(len(self.db.stored['ping']), 2)
+        self.assertEqual(self.count('ping', 'good', 'stored'), 2)
+        self.assertEqual(self.count('mtr', 'good', 'stored'), 1)
+        self.assertEqual(self.count('ping', 'good', 'rejected'), 0)
+
+    def test_partly_rejected_batch(self):
+        response = self.post_batch('mixed', {"ping": [{}, {"bad": True}, {"refused": True}], "mtr": [{"bad": True}]})
+        self.assertEqual(response.code, 200)
+        body = json.loads(response.body)
+        self.assertEqual(body["accepted"], 1)
+        self.assertEqual(sorted((i["type"], i["index"]) for i in body["rejected"]),
+                         [('mtr', 0), ('ping', 1), ('ping', 2)])
+        self.assertEqual(self.count('ping', 'mixed', 'stored'), 1)
+        self.assertEqual(self.count('ping', 'mixed', 'rejected'), 2)
+        self.assertEqual(self.count('mtr', 'mixed', 'rejected'), 1)